@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+
+# Benchmark suite for converting .msg files with outlookmsgfile.py.
+#
+# Each scenario generates a small corpus of synthetic .msg files with
+# msggen.py (varying the number of properties, the BODY size, the size
+# of the HTML in RTF_COMPRESSED, the number and size of attachments,
+# the nesting depth of embedded messages and STRING8 vs UNICODE
+# properties) and reports the wall time of load() and of as_bytes(),
+# the throughput in MB of .msg input per second, and the peak memory
+# allocated by Python during each for one message.
+#
+# Results can be saved as a baseline and later runs compared against
+# it, so that a change can be checked for regressions:
+#
+#   python benchmarks/bench_conversion.py --save baseline.json
+#   (make changes)
+#   python benchmarks/bench_conversion.py --compare baseline.json
+#
+# Usage:
+#
+#   python benchmarks/bench_conversion.py [--scenario NAME ...] [--repeat N]
+#     [--save FILE] [--compare FILE] [--threshold PERCENT]
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+import outlookmsgfile
+import msggen
+
+KB = 1024
+MB = 1024 * 1024
+
+# Scenarios: name -> (number of files, msggen.make_message arguments).
+SCENARIOS = {
+  "small":            (50, dict(property_count=20, body_size=1*KB)),
+  "many-properties":  (20, dict(property_count=1000, body_size=1*KB)),
+  "many-attachments": (5,  dict(property_count=300, attachment_count=300, attachment_size=1*KB)),
+  "large-body":       (5,  dict(body_size=1*MB)),
+  "string8":          (20, dict(property_count=200, body_size=64*KB, unicode=False)),
+  "headers":          (50, dict(body_size=1*KB, headers=True)),
+  "html":             (5,  dict(body_size=0, html_size=256*KB)),
+  "html-and-body":    (5,  dict(body_size=64*KB, html_size=256*KB)),
+  "attachments":      (5,  dict(attachment_count=20, attachment_size=256*KB)),
+  "large-attachment": (1,  dict(attachment_count=1, attachment_size=32*MB)),
+  "nested":           (5,  dict(depth=4, body_size=16*KB, attachment_count=2, attachment_size=64*KB)),
+}
+
+
+def generate_corpus(directory, name):
+  # Write the files of a scenario to directory and return their names.
+  count, kwargs = SCENARIOS[name]
+  filenames = []
+  for i in range(count):
+    filename = os.path.join(directory, "{}-{:04d}.msg".format(name, i))
+    with open(filename, "wb") as f:
+      f.write(msggen.generate(seed=i, **kwargs))
+    filenames.append(filename)
+  return filenames
+
+
+def run_scenario(filenames, repeat):
+  # Return the results of converting filenames, taking the best wall
+  # time of repeat runs. Memory is measured in a separate run on the
+  # first file only (the files of a scenario are alike), since
+  # tracemalloc slows everything down.
+  input_bytes = sum(os.path.getsize(fn) for fn in filenames)
+  load_time = as_bytes_time = float("inf")
+  output_bytes = 0
+  for _ in range(repeat):
+    t_load = t_as_bytes = 0
+    output_bytes = 0
+    for fn in filenames:
+      start = time.perf_counter()
+      msg = outlookmsgfile.load(fn)
+      middle = time.perf_counter()
+      output_bytes += len(msg.as_bytes())
+      t_load += middle - start
+      t_as_bytes += time.perf_counter() - middle
+      del msg
+    load_time = min(load_time, t_load)
+    as_bytes_time = min(as_bytes_time, t_as_bytes)
+
+  tracemalloc.start()
+  try:
+    msg = outlookmsgfile.load(filenames[0])
+    peak_load = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    msg.as_bytes()
+    peak_as_bytes = tracemalloc.get_traced_memory()[1]
+    del msg
+  finally:
+    tracemalloc.stop()
+
+  return {
+    "files": len(filenames),
+    "input_mb": input_bytes / MB,
+    "output_mb": output_bytes / MB,
+    "load_s": load_time,
+    "as_bytes_s": as_bytes_time,
+    "mb_per_s": input_bytes / MB / (load_time + as_bytes_time),
+    "peak_load_mb": peak_load / MB,
+    "peak_as_bytes_mb": peak_as_bytes / MB,
+  }
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+      stderr=subprocess.DEVNULL).decode("ascii").strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+# Results compared against a baseline, and whether larger is better.
+COMPARED = (("load_s", False), ("as_bytes_s", False), ("mb_per_s", True),
+  ("peak_load_mb", False), ("peak_as_bytes_mb", False))
+
+
+def compare(results, baseline, threshold):
+  # Print the change in each result from the baseline and return the
+  # number of results that got worse by more than threshold percent.
+  regressions = 0
+  print()
+  print("Compared with baseline from commit {} ({}):".format(baseline.get("commit"),
+    baseline.get("python")))
+  for name, result in results.items():
+    base = baseline["scenarios"].get(name)
+    if base is None:
+      print("  {:<18} not in baseline".format(name))
+      continue
+    changes = []
+    for key, larger_is_better in COMPARED:
+      if not base.get(key):
+        continue
+      change = (result[key] - base[key]) / base[key] * 100
+      worse = -change if larger_is_better else change
+      flag = ""
+      if worse > threshold:
+        flag = "!"
+        regressions += 1
+      changes.append("{} {:+.0f}%{}".format(key, change, flag))
+    print("  {:<18} {}".format(name, "  ".join(changes)))
+  if regressions:
+    print("{} result(s) regressed by more than {}% (marked !)".format(regressions, threshold))
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark .msg conversion on synthetic files.")
+  parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+    help="scenario to run (may be repeated; default: all)")
+  parser.add_argument("--repeat", type=int, default=3,
+    help="number of timed runs of each scenario (the best is reported)")
+  parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+  parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved baseline")
+  parser.add_argument("--threshold", type=float, default=10,
+    help="percentage by which a result must get worse to count as a regression")
+  args = parser.parse_args(argv)
+
+  results = { }
+  print("{:<18} {:>5} {:>8} {:>8} {:>10} {:>8} {:>10} {:>10}".format("scenario", "files",
+    "input MB", "load s", "as_bytes s", "MB/s", "peak load", "peak bytes"))
+  with tempfile.TemporaryDirectory() as directory:
+    for name in args.scenario or SCENARIOS:
+      filenames = generate_corpus(directory, name)
+      result = results[name] = run_scenario(filenames, args.repeat)
+      print("{:<18} {:>5} {:>8.1f} {:>8.3f} {:>10.3f} {:>8.1f} {:>8.1f}MB {:>8.1f}MB".format(name,
+        result["files"], result["input_mb"], result["load_s"], result["as_bytes_s"],
+        result["mb_per_s"], result["peak_load_mb"], result["peak_as_bytes_mb"]))
+      for fn in filenames:
+        os.unlink(fn)
+
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump({ "commit": git_commit(), "python": platform.python_version(),
+        "scenarios": results }, f, indent=2, sort_keys=True)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    if compare(results, baseline, args.threshold):
+      return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+
+# Benchmark of copying TRANSPORT_MESSAGE_HEADERS into a message, on
+# ordinary headers and on header blocks built to be slow to scan:
+# lines full of "Content-Type: ", fields with very many continuation
+# lines, very long lines, very many fields, and fields that aren't
+# ASCII (whose words or display names are encoded). Each case is run at
+# several sizes and the time per MB is reported, which stays about
+# the same as the size grows when the time taken is linear in the
+# size of the headers. The time includes writing the headers out.
+#
+# Sizes at which a case takes longer than --give-up seconds are
+# skipped for the larger sizes, so that the benchmark finishes when
+# comparing against a version that isn't linear.
+#
+#   python benchmarks/bench_headers.py --save headers.json
+#   python benchmarks/bench_headers.py --compare headers.json
+#
+# Usage:
+#
+#   python benchmarks/bench_headers.py [--case NAME ...] [--size KB ...]
+#     [--repeat N] [--give-up SECONDS] [--save FILE] [--compare FILE]
+
+import argparse
+import email.message
+import email.policy
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import outlookmsgfile
+
+KB = 1024
+MB = 1024 * 1024
+
+ORDINARY = (
+  "Received: from mail.example.com (mail.example.com [192.0.2.1])\r\n"
+  "\tby mx.example.net with ESMTPS id abcdef123456\r\n"
+  "\tfor <rcpt@example.net>; Thu, 1 Jan 2020 00:00:00 +0000\r\n"
+  "DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.com; s=sel;\r\n"
+  " h=from:to:subject:date; bh=47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=;\r\n"
+  " b=dGhpcyBpcyBub3QgYSByZWFsIHNpZ25hdHVyZSBidXQgaXQgbG9va3MgbGlrZSBvbmU=\r\n"
+  "List-Unsubscribe: <mailto:unsubscribe@lists.example.com>\r\n"
+  "X-Mailing-List: list@lists.example.com\r\n"
+)
+
+# Cases: name -> function returning a header block of about size bytes.
+CASES = {
+  "ordinary": lambda size:
+    ORDINARY * (size // len(ORDINARY)) + "Subject: Test\r\n\r\n",
+  "content-type-repeated": lambda size:
+    "X-Note: " + "Content-Type: " * (size // 14),
+  "content-type-continuations": lambda size:
+    ("Content-Type: multipart/mixed;" + "\r\n " * 50 + "\r\n") * (size // 183),
+  "long-continuations": lambda size:
+    "X-Long: start" + "\r\n continued" * (size // 11) + "\r\n\r\n",
+  "long-line": lambda size:
+    "X-Long: " + "a" * size + "\r\n\r\n",
+  "many-fields": lambda size:
+    "".join("X-Field-{}: value\r\n".format(i) for i in range(size // 20)) + "\r\n",
+  "non-ascii-words": lambda size:
+    "Subject: " + "caf\u00e9 cr\u00e8me na\u00efve " * (size // 23) + "\r\n\r\n",
+  "non-ascii-continuations": lambda size:
+    "X-Note: d\u00e9but" + "\r\n suite \u00e9t\u00e9" * (size // 14) + "\r\n\r\n",
+  "non-ascii-addresses": lambda size:
+    "To: " + "\"M\u00fcller, J\u00f6rg\" <j@example.de>, " * (size // 33) + "a@example.de\r\n\r\n",
+  "non-ascii-line": lambda size:
+    "X-Long: " + "\u00e9" * (size // 2) + "\r\n\r\n",
+}
+
+
+def time_case(headers, repeat):
+  # Return the best time of repeat runs of adding the headers to a
+  # message and writing it out.
+  best = float("inf")
+  for _ in range(repeat):
+    start = time.perf_counter()
+    # (Older versions, which can be compared against, have no MESSAGE_POLICY.)
+    msg = email.message.EmailMessage(policy=getattr(outlookmsgfile, "MESSAGE_POLICY",
+      email.policy.default))
+    outlookmsgfile.add_headers(msg, { "TRANSPORT_MESSAGE_HEADERS": headers })
+    msg.as_bytes()
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark copying transport headers.")
+  parser.add_argument("--case", action="append", choices=sorted(CASES),
+    help="case to run (may be repeated; default: all)")
+  parser.add_argument("--size", action="append", type=int, metavar="KB",
+    help="size of the headers in KB (may be repeated; default: 16, 64 and 256)")
+  parser.add_argument("--repeat", type=int, default=3,
+    help="number of timed runs of each case (the best is reported)")
+  parser.add_argument("--give-up", type=float, default=10, metavar="SECONDS",
+    help="skip the larger sizes of a case once one takes longer than this")
+  parser.add_argument("--save", metavar="FILE", help="save the results")
+  parser.add_argument("--compare", metavar="FILE", help="compare the results with saved results")
+  args = parser.parse_args(argv)
+
+  sizes = args.size or [16, 64, 256]
+  results = { }
+  print("{:<28} {:>8} {:>10} {:>10}".format("case", "size KB", "seconds", "s per MB"))
+  for name in args.case or CASES:
+    for size in sizes:
+      headers = CASES[name](size * KB)
+      seconds = time_case(headers, args.repeat)
+      key = "{}/{}".format(name, size)
+      results[key] = seconds
+      print("{:<28} {:>8} {:>10.4f} {:>10.3f}".format(name, size, seconds,
+        seconds / (len(headers) / MB)))
+      if seconds > args.give_up:
+        print("{:<28} (larger sizes skipped)".format(name))
+        break
+
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    print("compared with {}:".format(args.compare))
+    for key, seconds in results.items():
+      if baseline.get(key):
+        print("  {:<34} {:+.0f}%".format(key, (seconds - baseline[key]) / baseline[key] * 100))
+
+
+if __name__ == "__main__":
+  main()
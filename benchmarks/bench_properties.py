@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+
+# Microbenchmark for decoding the property entry table of a .msg
+# properties stream, comparing parse_properties with the byte-slicing
+# loop and reduce()-based integer decoding it replaced, and for finding
+# the streams that hold property values in a storage with many
+# children, comparing stream_index with looking each up by name.
+#
+# Usage:
+#
+#   python benchmarks/bench_properties.py [--entries N] [--repeat N]
+#     [--properties N] [--attachments N]
+
+import argparse
+import io
+import os
+import random
+import struct
+import sys
+import timeit
+from functools import reduce
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+import outlookmsgfile
+import msggen
+
+
+def make_properties_stream(entries, seed=0):
+  # A top-level properties stream holding a mix of fixed-length and
+  # variable-length property entries with known tags.
+  rng = random.Random(seed)
+  types = [0x2, 0x3, 0xb, 0x14, 0x40, 0x1f, 0x102]
+  tags = sorted(outlookmsgfile.property_tags)
+  data = bytearray(32)
+  for _ in range(entries):
+    property_type = rng.choice(types)
+    if property_type == 0x40:
+      value = rng.randrange(120000000000000000, 140000000000000000) # 1981-2044
+    else:
+      value = rng.getrandbits(63)
+    data += struct.pack("<HHLQ", property_type, rng.choice(tags), 6, value)
+  return bytes(data)
+
+
+class _Document(object):
+  # Just enough of a CompoundFileReader for parse_properties to read
+  # the properties stream. Variable-length values are never accessed.
+  mapped = None
+
+  def open(self, data):
+    return io.BytesIO(data)
+
+
+def old_parse_properties(stream, is_top_level):
+  # The entry table loop and fixed-length loaders as they were before
+  # they used struct.
+  def load_fixed(property_type, value):
+    if property_type == 0x2:
+      return reduce(lambda a, b : (a<<8)+b, reversed(value[0:2]))
+    if property_type == 0x3:
+      return reduce(lambda a, b : (a<<8)+b, reversed(value[0:4]))
+    if property_type == 0x14:
+      return reduce(lambda a, b : (a<<8)+b, reversed(value))
+    if property_type == 0x40:
+      from datetime import datetime, timedelta
+      value = reduce(lambda a, b : (a<<8)+b, reversed(value))
+      return datetime(1601, 1, 1) + timedelta(seconds=value/10000000)
+    if property_type == 0xb:
+      return value[0] == 1
+    return None
+
+  i = (32 if is_top_level else 24)
+  raw_properties = { }
+  while i < len(stream):
+    property_type  = stream[i+0:i+2]
+    property_tag = stream[i+2:i+4]
+    value = stream[i+8:i+16]
+    i += 16
+    property_type = property_type[0] + (property_type[1]<<8)
+    property_tag = property_tag[0] + (property_tag[1]<<8)
+    if property_tag not in outlookmsgfile.property_tags: continue
+    tag_name, _ = outlookmsgfile.property_tags[property_tag]
+    raw_properties[tag_name] = (property_type, value)
+
+  properties = { }
+  for tag_name, (property_type, value) in raw_properties.items():
+    properties[tag_name] = load_fixed(property_type, value)
+  return properties
+
+
+def lookup_by_name(container, stream_keys):
+  # Find the streams the way parse_properties did before stream_index.
+  streams = []
+  for stream_key in stream_keys:
+    try:
+      streams.append(container["__substg1.0_%04X%04X" % stream_key])
+    except KeyError:
+      pass
+  return streams
+
+
+def lookup_by_index(container, stream_keys):
+  index = outlookmsgfile.stream_index(container)
+  return [index[stream_key] for stream_key in stream_keys if stream_key in index]
+
+
+def bench_lookups(properties, attachments, repeat):
+  # Time finding the streams of all of the variable-length properties
+  # of the top-level message of a generated .msg file, which has
+  # about properties properties and attachments attachment storages.
+  data = msggen.generate(property_count=properties, attachment_count=attachments,
+    attachment_size=16)
+  with outlookmsgfile.open_document(io.BytesIO(data)) as doc:
+    container = doc.root
+    props = outlookmsgfile.parse_properties(container['__properties_version1.0'], True,
+      container, doc)
+    stream_keys = [stream_key for _, stream_key in props._pending.values()]
+    assert lookup_by_name(container, stream_keys) == lookup_by_index(container, stream_keys)
+    old = min(timeit.repeat(lambda: lookup_by_name(container, stream_keys), number=repeat, repeat=5))
+    new = min(timeit.repeat(lambda: lookup_by_index(container, stream_keys), number=repeat, repeat=5))
+    print("{} streams found among {} children, {} iterations".format(len(stream_keys),
+      len(container), repeat))
+  print("  lookup by name:    {:8.1f} us per message".format(old / repeat * 1e6))
+  print("  stream_index:      {:8.1f} us per message".format(new / repeat * 1e6))
+  print("  speedup:           {:8.2f}x".format(old / new))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--entries", type=int, default=500)
+  parser.add_argument("--repeat", type=int, default=2000)
+  parser.add_argument("--properties", type=int, default=300,
+    help="number of properties of the message in the stream lookup benchmark")
+  parser.add_argument("--attachments", type=int, default=300,
+    help="number of attachments of the message in the stream lookup benchmark")
+  args = parser.parse_args(argv)
+
+  stream = make_properties_stream(args.entries)
+  doc = _Document()
+
+  old = min(timeit.repeat(lambda: old_parse_properties(stream, True), number=args.repeat, repeat=5))
+  new = min(timeit.repeat(lambda: outlookmsgfile.parse_properties(stream, True, None, doc),
+    number=args.repeat, repeat=5))
+
+  print("{} entries, {} iterations".format(args.entries, args.repeat))
+  print("  byte-slicing loop: {:8.1f} us per stream".format(old / args.repeat * 1e6))
+  print("  parse_properties:  {:8.1f} us per stream".format(new / args.repeat * 1e6))
+  print("  speedup:           {:8.2f}x".format(old / new))
+
+  bench_lookups(args.properties, args.attachments, max(args.repeat // 20, 1))
+
+
+if __name__ == "__main__":
+  main()
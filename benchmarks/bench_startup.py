@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+
+# Benchmark of start-up time: how long importing outlookmsgfile takes
+# (from python -X importtime, with the slowest imports listed), and the
+# wall time of converting one small message from the command line,
+#
+#   python outlookmsgfile.py < message.msg > message.eml
+#   python -m outlookmsgfile < message.msg > message.eml
+#
+# compared with starting Python and doing nothing, and with the time
+# per message of converting many messages in one process in pipe mode
+# (--pipe). Running the module as a script compiles it every time,
+# while -m uses the compiled bytecode cached in __pycache__.
+#
+# Results can be saved and compared like bench_conversion.py's:
+#
+#   python benchmarks/bench_startup.py --save startup.json
+#   python benchmarks/bench_startup.py --compare startup.json
+#
+# Usage:
+#
+#   python benchmarks/bench_startup.py [--repeat N] [--save FILE] [--compare FILE]
+
+import argparse
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+sys.path.insert(0, HERE)
+import msggen
+
+
+def subprocess_env():
+  # Let Python cache bytecode as it normally would, even if this is
+  # run with it turned off, and find outlookmsgfile for -m.
+  env = dict(os.environ)
+  env.pop("PYTHONDONTWRITEBYTECODE", None)
+  env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+  return env
+
+
+def import_times(repeat):
+  # Return a list of the cumulative import time of outlookmsgfile in
+  # seconds for each run, and the list of (self time, module) tuples
+  # of the run with the median time.
+  env = subprocess_env()
+  runs = []
+  for _ in range(repeat + 1):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import outlookmsgfile"],
+      env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    modules = []
+    total = None
+    for line in result.stderr.decode("utf-8").splitlines():
+      if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+        continue
+      self_us, cumulative_us, name = line[len("import time:"):].split("|")
+      modules.append((int(self_us) / 1e6, name.rstrip()))
+      if name.strip() == "outlookmsgfile":
+        total = int(cumulative_us) / 1e6
+    runs.append((total, modules))
+  runs = sorted(runs[1:]) # the first run writes the bytecode cache
+  return [total for total, _ in runs], runs[len(runs) // 2][1]
+
+
+def command_times(command, stdin_filename, repeat):
+  # Return a list of the wall times of running command in seconds.
+  env = subprocess_env()
+  times = []
+  for _ in range(repeat + 1):
+    with open(stdin_filename, "rb") as stdin:
+      start = time.perf_counter()
+      subprocess.run(command, env=env, cwd=ROOT, stdin=stdin, stdout=subprocess.DEVNULL, check=True)
+      times.append(time.perf_counter() - start)
+  return times[1:]
+
+
+def pipe_time(filename, count):
+  # Return the wall time per message of converting the file count
+  # times, one after another, in one process in pipe mode (including
+  # starting it).
+  with open(filename, "rb") as f:
+    data = f.read()
+  frame = struct.pack(">Q", len(data)) + data
+  start = time.perf_counter()
+  process = subprocess.Popen([sys.executable, "-m", "outlookmsgfile", "--pipe"],
+    env=subprocess_env(), cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  for _ in range(count):
+    process.stdin.write(frame)
+    process.stdin.flush()
+    status, length = struct.unpack(">BQ", process.stdout.read(9))
+    process.stdout.read(length)
+    assert status == 0
+  process.stdin.close()
+  process.wait()
+  return (time.perf_counter() - start) / count
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark start-up time.")
+  parser.add_argument("--repeat", type=int, default=10)
+  parser.add_argument("--save", metavar="FILE", help="save the results")
+  parser.add_argument("--compare", metavar="FILE", help="compare the results with saved results")
+  args = parser.parse_args(argv)
+
+  results = { }
+  totals, modules = import_times(args.repeat)
+  results["import"] = statistics.median(totals)
+  print("import outlookmsgfile: {:.1f} ms (median of {}; min {:.1f} ms)".format(
+    results["import"] * 1000, len(totals), min(totals) * 1000))
+  print("  slowest imports in the median run (self time):")
+  for seconds, name in sorted(modules, reverse=True)[:10]:
+    print("    {:6.1f} ms  {}".format(seconds * 1000, name.strip()))
+
+  with tempfile.NamedTemporaryFile(suffix=".msg", delete=False) as f:
+    f.write(msggen.generate(seed=0, headers=True))
+  try:
+    commands = {
+      "python -c pass": [sys.executable, "-c", "pass"],
+      "python outlookmsgfile.py": [sys.executable, os.path.join(ROOT, "outlookmsgfile.py")],
+      "python -m outlookmsgfile": [sys.executable, "-m", "outlookmsgfile"],
+    }
+    print("converting one message (median wall time):")
+    for name, command in commands.items():
+      results[name] = statistics.median(command_times(command, f.name, args.repeat))
+      print("  {:<32} {:6.1f} ms".format(name, results[name] * 1000))
+    name = "python -m outlookmsgfile --pipe"
+    results[name] = pipe_time(f.name, args.repeat * 10)
+    print("  {:<32} {:6.1f} ms per message ({} messages)".format(name, results[name] * 1000,
+      args.repeat * 10))
+  finally:
+    os.unlink(f.name)
+
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    print("compared with {}:".format(args.compare))
+    for name, seconds in results.items():
+      if baseline.get(name):
+        print("  {:<32} {:+.0f}%".format(name, (seconds - baseline[name]) / baseline[name] * 100))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+
+# Benchmark of the ways of making a plain-text body from an HTML-only
+# message body (the text_backfill option), on synthetic marketing-style
+# HTML of increasing size.
+#
+# Usage:
+#
+#   python benchmarks/bench_text_backfill.py [--sizes KB,KB,...] [--repeat N]
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import outlookmsgfile
+
+
+WORDS = ("offer", "exclusive", "members", "discount", "today", "free", "shipping", "new",
+  "collection", "limited", "time", "save", "your", "order", "now", "the", "and", "for")
+
+
+def make_html(size, seed=0):
+  # HTML laid out with nested tables, inline styles, links and images,
+  # like a newsletter, of about size characters.
+  rng = random.Random(seed)
+  def words(n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+  parts = ["<html><head><title>", words(5), "</title><style>td { font-family: Arial; }"
+    " .btn { color: #fff; }</style></head><body><table width=\"600\" cellpadding=\"0\">"]
+  length = sum(len(p) for p in parts)
+  while length < size:
+    row = ("<tr><td style=\"padding: 10px; color: #333333; font-size: 14px\">"
+      "<h2>{}</h2><p>{} <a href=\"https://example.com/{}\">{}</a> &amp; {}</p>"
+      "<img src=\"https://example.com/{}.png\" alt=\"{}\" width=\"600\"><br>"
+      "<table><tr><td class=\"btn\">{}</td><td>{}&nbsp;&euro;</td></tr></table>"
+      "</td></tr>\n").format(words(4), words(40), rng.getrandbits(32), words(3), words(20),
+      rng.getrandbits(32), words(2), words(2), rng.randrange(100))
+    parts.append(row)
+    length += len(row)
+  parts.append("</table></body></html>")
+  return "".join(parts)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--sizes", default="10,100,500,2000",
+    help="HTML body sizes in KB (default: %(default)s)")
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args(argv)
+
+  print("{:>8}  {:>12}  {:>12}  {:>8}".format("HTML KB", "html2text s", "fast s", "speedup"))
+  for size in [int(s) for s in args.sizes.split(",")]:
+    html = make_html(size * 1024)
+    times = { }
+    for name in ("html2text", "fast"):
+      times[name] = min(timeit.repeat(lambda: outlookmsgfile.html_to_text(html, name),
+        number=1, repeat=args.repeat))
+    print("{:>8}  {:>12.3f}  {:>12.3f}  {:>7.1f}x".format(size, times["html2text"], times["fast"],
+      times["html2text"] / times["fast"]))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+
+# Generates synthetic Microsoft Outlook .msg files for benchmarking
+# outlookmsgfile.py without needing a corpus of real messages or
+# network access.
+#
+# The generator builds message, attachment and embedded message
+# storages and writes them with outlookmsgfile's minimal writer for
+# the Compound File Binary format.
+#
+# Usage:
+#
+#   python benchmarks/msggen.py OUTPUT_DIR [--count N] [--body-size BYTES] ...
+
+import argparse
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from outlookmsgfile import property_tags, write_compound_file
+
+# MESSAGE BUILDER
+
+PT_INTEGER32 = 0x3
+PT_BOOLEAN = 0xb
+PT_OBJECT = 0xd
+PT_SYSTIME = 0x40
+PT_STRING8 = 0x1e
+PT_UNICODE = 0x1f
+PT_BINARY = 0x102
+
+
+def _property_stream(header_size, props, storage):
+  # props is a list of (tag, type, value) tuples. Fixed-length values
+  # are stored inline, variable-length values get their own substream.
+  data = bytearray(header_size)
+  for tag, ptype, value in props:
+    if ptype in (PT_INTEGER32, PT_BOOLEAN):
+      inline = struct.pack("<Q", int(value))
+    elif ptype == PT_SYSTIME:
+      inline = struct.pack("<Q", value)
+    elif ptype == PT_OBJECT:
+      storage["__substg1.0_{:04X}{:04X}".format(tag, ptype)] = value
+      inline = struct.pack("<LL", 0xFFFFFFFF, 0)
+    else:
+      storage["__substg1.0_{:04X}{:04X}".format(tag, ptype)] = value
+      inline = struct.pack("<LL", len(value), 0)
+    data += struct.pack("<HHL", ptype, tag, 6) + inline
+  storage["__properties_version1.0"] = bytes(data)
+
+
+def _string(text, unicode):
+  if unicode:
+    return (PT_UNICODE, text.encode("utf-16le"))
+  return (PT_STRING8, text.encode("cp1252", errors="replace"))
+
+
+def html_to_rtf(html):
+  # Encapsulate HTML in RTF the way Outlook does, using \fromhtml1
+  # and \*\htmltag groups.
+  out = ["{\\rtf1\\ansi\\ansicpg1252\\fromhtml1 \\deff0{\\fonttbl{\\f0\\fswiss Arial;}}\r\n"]
+  for chunk in html.split("<"):
+    if not chunk:
+      continue
+    tag, _, text = chunk.partition(">")
+    tag = "<" + tag + ">"
+    tag = tag.replace("\\", "\\\\").replace("{", "\\{").replace("}", "\\}")
+    out.append("{\\*\\htmltag64 " + tag + "}")
+    if text:
+      escaped = text.replace("\\", "\\\\").replace("{", "\\{").replace("}", "\\}")
+      out.append(escaped)
+  out.append("}")
+  return "".join(out).encode("cp1252", errors="replace")
+
+
+def compress_rtf(rtf):
+  # Return rtf in the RTF_COMPRESSED format. compressed_rtf.compress
+  # searches for matches in pure Python and takes minutes on large
+  # bodies, so this writes a compressed stream made only of literal
+  # runs, which compressed_rtf.decompress (and Outlook) read the same
+  # way as any other.
+  from compressed_rtf.compressed_rtf import COMPRESSED, INIT_DICT_SIZE, MAX_DICT_SIZE, crc32
+  out = bytearray()
+  for i in range(0, len(rtf) - len(rtf) % 8, 8):
+    out.append(0)
+    out += rtf[i:i + 8]
+  # The last run ends with a reference to the current dictionary
+  # position, which marks the end of the stream.
+  tail = rtf[len(rtf) - len(rtf) % 8:]
+  out.append(1 << len(tail))
+  out += tail
+  out += struct.pack(">H", ((INIT_DICT_SIZE + len(rtf)) % MAX_DICT_SIZE) << 4)
+  out = bytes(out)
+  return struct.pack("<II", len(out) + 12, len(rtf)) + COMPRESSED + struct.pack("<I", crc32(out)) + out
+
+
+def _filler_tags():
+  # The tags of string and binary properties that the reader knows
+  # (it skips others) and doesn't interpret, as (tag, type) pairs.
+  interpreted = ("ATTACH_DATA_BIN", "ATTACH_FILENAME", "ATTACH_LONG_FILENAME", "ATTACH_MIME_TAG",
+    "BODY", "DISPLAY_BCC", "DISPLAY_CC", "DISPLAY_NAME", "DISPLAY_TO", "RTF_COMPRESSED",
+    "SENDER_NAME", "SENT_REPRESENTING_NAME", "SUBJECT", "TRANSPORT_MESSAGE_HEADERS")
+  types = { "STRING": PT_UNICODE, "BINARY": PT_BINARY }
+  return [(tag, types[ptype]) for tag, (name, ptype) in sorted(property_tags.items())
+    if ptype in types and name not in interpreted]
+
+FILLER_TAGS = _filler_tags()
+
+
+def make_message(rng, property_count=20, body_size=1024, html_size=0,
+    attachment_count=0, attachment_size=1024, depth=0, unicode=True,
+    headers=False, top_level=True):
+  storage = { }
+  props = []
+
+  words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+  def text(size):
+    out = []
+    n = 0
+    while n < size:
+      w = rng.choice(words)
+      out.append(w)
+      n += len(w) + 1
+    return " ".join(out)[:size]
+
+  props.append((0x37,) + _string("Synthetic message " + text(30), unicode))
+  props.append((0x0C1A,) + _string("Sender Name", unicode))
+  props.append((0x0E04,) + _string("Recipient One; Recipient Two", unicode))
+  props.append((0x0E03,) + _string("Copied Person", unicode))
+  props.append((0x0E06, PT_SYSTIME, 132000000000000000))
+  props.append((0x3FDE, PT_INTEGER32, 65001))
+  if headers:
+    hdr = ("Received: from a.example by b.example; Thu, 1 Jan 2020 00:00:00 +0000\r\n"
+           "From: Sender <sender@example.com>\r\nTo: rcpt@example.com\r\n"
+           "Subject: Synthetic\r\nDate: Thu, 1 Jan 2020 00:00:00 +0000\r\n"
+           "Content-Type: text/plain;\r\n charset=utf-8\r\nMIME-Version: 1.0\r\n\r\n")
+    props.append((0x7D,) + _string(hdr, unicode))
+  if body_size:
+    props.append((0x1000,) + _string(text(body_size), unicode))
+  if html_size:
+    html = "<html><body><p>" + text(html_size).replace(" ", "</p><p>", html_size // 200) + "</p></body></html>"
+    props.append((0x1009, PT_BINARY, compress_rtf(html_to_rtf(html))))
+
+  # Pad with filler properties to reach the requested count: a few
+  # integers, then strings and binary values with distinct tags, each
+  # in its own substream, then (when those run out) more strings with
+  # a repeated tag, which overwrite each other.
+  filler_tags = [0x0E07, 0x0E08, 0x1006, 0x0E21, 0x0E20]
+  variable_tags = [(tag, ptype) for tag, ptype in FILLER_TAGS
+    if tag not in {prop[0] for prop in props}]
+  i = 0
+  while len(props) < property_count:
+    if i < len(filler_tags):
+      props.append((filler_tags[i], PT_INTEGER32, rng.randrange(1 << 31)))
+    elif i - len(filler_tags) < len(variable_tags):
+      tag, ptype = variable_tags[i - len(filler_tags)]
+      if ptype == PT_BINARY:
+        props.append((tag, PT_BINARY, bytes(rng.getrandbits(8) for _ in range(16))))
+      else:
+        props.append((tag,) + _string("Filler " + str(i), unicode))
+    else:
+      props.append((0x3001,) + _string("Display name " + str(i), unicode))
+    i += 1
+
+  for n in range(attachment_count):
+    attach = { }
+    payload = bytes(rng.getrandbits(8) for _ in range(min(attachment_size, 256)))
+    payload = (payload * (attachment_size // max(len(payload), 1) + 1))[:attachment_size]
+    attach_props = [
+      # The reader skips the first entry of non-top-level property streams.
+      (0x0E21, PT_INTEGER32, n),
+      (0x3701, PT_BINARY, payload),
+      (0x3707,) + _string("attachment{}.bin".format(n), unicode),
+      (0x370E,) + _string("application/octet-stream", unicode),
+      (0x3705, PT_INTEGER32, 1),
+    ]
+    _property_stream(8, attach_props, attach)
+    storage["__attach_version1.0_#{:08X}".format(n)] = attach
+
+  if depth > 0:
+    attach = { }
+    nested = make_message(rng, property_count=property_count, body_size=body_size,
+      html_size=html_size, attachment_count=attachment_count,
+      attachment_size=attachment_size, depth=depth - 1, unicode=unicode,
+      headers=headers, top_level=False)
+    attach_props = [
+      (0x0E21, PT_INTEGER32, attachment_count),
+      (0x3701, PT_OBJECT, nested),
+      (0x3001,) + _string("Forwarded message", unicode),
+      (0x3705, PT_INTEGER32, 5),
+    ]
+    _property_stream(8, attach_props, attach)
+    storage["__attach_version1.0_#{:08X}".format(attachment_count)] = attach
+
+  _property_stream(32 if top_level else 24, props, storage)
+  return storage
+
+
+def generate(seed=0, **kwargs):
+  # Return the bytes of a synthetic .msg file.
+  rng = random.Random(seed)
+  return write_compound_file(make_message(rng, **kwargs))
+
+
+# COMMAND-LINE ENTRY POINT
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Generate synthetic .msg files.")
+  parser.add_argument("output_dir")
+  parser.add_argument("--count", type=int, default=10)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--properties", type=int, default=20)
+  parser.add_argument("--body-size", type=int, default=1024)
+  parser.add_argument("--html-size", type=int, default=0)
+  parser.add_argument("--attachments", type=int, default=0)
+  parser.add_argument("--attachment-size", type=int, default=1024)
+  parser.add_argument("--depth", type=int, default=0)
+  parser.add_argument("--string8", action="store_true", help="use STRING8 instead of UNICODE properties")
+  parser.add_argument("--headers", action="store_true", help="include TRANSPORT_MESSAGE_HEADERS")
+  args = parser.parse_args(argv)
+
+  os.makedirs(args.output_dir, exist_ok=True)
+  for i in range(args.count):
+    data = generate(seed=args.seed + i, property_count=args.properties,
+      body_size=args.body_size, html_size=args.html_size,
+      attachment_count=args.attachments, attachment_size=args.attachment_size,
+      depth=args.depth, unicode=not args.string8, headers=args.headers)
+    with open(os.path.join(args.output_dir, "message{:06d}.msg".format(i)), "wb") as f:
+      f.write(data)
+
+
+if __name__ == "__main__":
+  main()
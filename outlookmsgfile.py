@@ -19,94 +19,252 @@ import logging
 import os
 import sys
 import io
-
-from functools import reduce
-
-import email.message, email.parser, email.policy
-from email.utils import parsedate_to_datetime, formatdate, formataddr
-
-import compoundfiles
-from rtfparse.parser import Rtf_Parser
-from rtfparse.renderers.html_decapsulator import HTML_Decapsulator
-import html2text
+import base64
+import collections.abc
+import struct
+import functools
+import itertools
+import contextlib
+import mmap
+import threading
+import time
+from datetime import datetime, timedelta
+
+import email.message, email.parser, email.policy, email.generator
+from email.utils import formatdate, formataddr
+
+# compoundfiles, compressed_rtf, rtfparse, html2text and the heavier
+# standard library modules are imported where they are first used, so
+# that starting up doesn't pay for what a conversion may not need.
 
 logger = logging.getLogger(__name__)
 
 FALLBACK_ENCODING = 'cp1252'
 
-# MAIN FUNCTIONS
-
-
-def load(filename_or_stream):
-  with compoundfiles.CompoundFileReader(filename_or_stream) as doc:
-    doc.rtf_attachments = 0
-    return load_message_stream(doc.root, True, doc)
+# The policy of the messages made here. Headers copied from the
+# original message's transport headers are written out as they were,
+# rather than being refolded if they have long lines.
+MESSAGE_POLICY = email.policy.default.clone(refold_source="none")
 
+# MAIN FUNCTIONS
 
-def load_message_stream(entry, is_top_level, doc):
-  # Load stream data.
-  props = parse_properties(entry['__properties_version1.0'], is_top_level, entry, doc)
-
-  # Construct the MIME message....
-  msg = email.message.EmailMessage()
-
-  # Add the raw headers, if known.
-  if 'TRANSPORT_MESSAGE_HEADERS' in props:
-    # Get the string holding all of the headers.
-    headers = props['TRANSPORT_MESSAGE_HEADERS']
-    if isinstance(headers, bytes):
-      headers = headers.decode("utf-8")
-
-    # Remove content-type header because the body we can get this
-    # way is just the plain-text portion of the email and whatever
-    # Content-Type header was in the original is not valid for
-    # reconstructing it this way.
-    headers = re.sub(r"Content-Type: .*(\n\s.*)*\n", "", headers, flags=re.I)
 
-    # Parse them.
-    headers = email.parser.HeaderParser(policy=email.policy.default)\
-      .parsestr(headers)
+def load(filename_or_stream, zero_copy=False, spill_threshold=None, rtf_cache=None,
+    text_backfill="html2text", text_backfill_limit=None, instrument=None, cache=None,
+    attachment_store=None, max_depth=None, max_embedded_bytes=None, budget=None):
+  # If cache is a ConversionCache, a message that is in it is parsed
+  # from the cached MIME output instead of being converted, and a
+  # message that isn't is added to it.
+  #
+  # If attachment_store is an AttachmentStore, attachment content is
+  # put in it and referred to from the message (see AttachmentStore).
+  #
+  # max_depth and max_embedded_bytes limit the conversion of attached
+  # messages, and budget (a ResourceBudget) the resources used by the
+  # conversion (see open_document).
+  if budget is not None and budget.degrade:
+    cache = None # the output may be cut down
+  if cache is not None:
+    _check_budget(filename_or_stream, budget)
+    cache_key = _cache_key(cache, filename_or_stream, text_backfill, text_backfill_limit,
+      attachment_store, max_depth, max_embedded_bytes)
+    cached = cache.open(cache_key)
+    if cached is not None:
+      with cached:
+        return email.parser.BytesParser(policy=MESSAGE_POLICY).parse(cached)
+
+  with open_document(filename_or_stream, zero_copy=zero_copy, spill_threshold=spill_threshold,
+      rtf_cache=rtf_cache, text_backfill=text_backfill,
+      text_backfill_limit=text_backfill_limit, instrument=instrument,
+      attachment_store=attachment_store, max_depth=max_depth,
+      max_embedded_bytes=max_embedded_bytes, budget=budget) as doc:
+    msg = load_message_stream(doc.root, True, doc)
+    load_embedded_messages(msg)
+
+  if cache is not None:
+    with cache.writer(cache_key) as f:
+      if f is not None:
+        write_message(msg, f)
+  return msg
 
-    # Copy them into the message object.
-    for header, value in headers.items():
-      msg[header] = value
 
-  else:
-    # Construct common headers from metadata.
+def convert(filename_or_stream, dst_stream, zero_copy=False, rtf_cache=None,
+    text_backfill="html2text", text_backfill_limit=None, instrument=None, cache=None,
+    attachment_store=None, max_depth=None, max_embedded_bytes=None, budget=None):
+  # Convert a .msg file and write it in MIME format to the binary
+  # file-like object dst_stream. The output is the same as writing
+  # load(filename_or_stream).as_bytes(), except that attachment
+  # content is not loaded into memory: it is copied from the .msg
+  # file and base64-encoded in chunks as the message is written,
+  # and the message is written part by part rather than being
+  # rendered into one big string first. Attached messages are
+  # converted one at a time as they are written.
+  #
+  # If cache is a ConversionCache, the output for a message that is in
+  # it is copied from the cache, and the output for a message that
+  # isn't is added to it.
+  if budget is not None and budget.degrade:
+    cache = None # the output may be cut down
+  if cache is None:
+    _convert(filename_or_stream, dst_stream, zero_copy, rtf_cache, text_backfill,
+      text_backfill_limit, instrument, attachment_store, max_depth, max_embedded_bytes, budget)
+    return
+
+  _check_budget(filename_or_stream, budget)
+  cache_key = _cache_key(cache, filename_or_stream, text_backfill, text_backfill_limit,
+    attachment_store, max_depth, max_embedded_bytes)
+  cached = cache.open(cache_key)
+  if cached is not None:
+    import shutil
+    with cached:
+      shutil.copyfileobj(cached, dst_stream, SPILL_CHUNK_SIZE)
+    return
+  with cache.writer(cache_key) as f:
+    if f is not None:
+      dst_stream = _TeeWriter(dst_stream, f)
+    _convert(filename_or_stream, dst_stream, zero_copy, rtf_cache, text_backfill,
+      text_backfill_limit, instrument, attachment_store, max_depth, max_embedded_bytes, budget)
+
+
+def _convert(filename_or_stream, dst_stream, zero_copy, rtf_cache, text_backfill,
+    text_backfill_limit, instrument, attachment_store, max_depth, max_embedded_bytes, budget):
+  with open_document(filename_or_stream, stream_attachments=True, zero_copy=zero_copy,
+      rtf_cache=rtf_cache, text_backfill=text_backfill,
+      text_backfill_limit=text_backfill_limit, instrument=instrument,
+      attachment_store=attachment_store, max_depth=max_depth,
+      max_embedded_bytes=max_embedded_bytes, budget=budget) as doc:
+    msg = load_message_stream(doc.root, True, doc)
+    started = time.perf_counter() if doc.instrument is not None else None
+    write_message(msg, dst_stream)
+    if started is not None:
+      report_stage(doc, "serialize", started)
+
+
+def _check_budget(filename_or_stream, budget):
+  # Raise BudgetExceeded if a message is over a budget (which doesn't
+  # degrade), before its output is taken from a cache without being
+  # converted. Only the compound file's directory is read.
+  if budget is not None:
+    with open_document(filename_or_stream, budget=budget):
+      pass
 
-    if 'MESSAGE_DELIVERY_TIME' in props:
-        msg['Date'] = formatdate(props['MESSAGE_DELIVERY_TIME'].timestamp())
-        del props['MESSAGE_DELIVERY_TIME']
 
-    if 'SENDER_NAME' in props:
-        if 'SENT_REPRESENTING_NAME' in props:
-            if props['SENT_REPRESENTING_NAME']:
-                if props['SENDER_NAME'] != props['SENT_REPRESENTING_NAME']:
-                  props['SENDER_NAME'] += " (" + props['SENT_REPRESENTING_NAME'] + ")"
-            del props['SENT_REPRESENTING_NAME']
-        if props['SENDER_NAME']:
-            msg['From'] = formataddr((props['SENDER_NAME'], ""))
-        del props['SENDER_NAME']
+def _cache_key(cache, filename_or_stream, text_backfill, text_backfill_limit, attachment_store,
+    max_depth, max_embedded_bytes):
+  # The output refers to the files in an attachment store by path, so
+  # it depends on which store is used. Options that aren't set are
+  # left out, so that keys made before they existed stay the same.
+  options = { }
+  if attachment_store is not None:
+    options["attachment_store"] = attachment_store.directory
+  if max_depth is not None:
+    options["max_depth"] = max_depth
+  if max_embedded_bytes is not None:
+    options["max_embedded_bytes"] = max_embedded_bytes
+  return cache.key(filename_or_stream, text_backfill=text_backfill,
+    text_backfill_limit=text_backfill_limit, **options)
+
+
+def load_headers(filename_or_stream):
+  # Like load(), but return a message with just the headers
+  # and no body or attachments. Only the top-level properties
+  # stream and the streams of the properties used to make the
+  # headers are read, so this is much faster than load() for
+  # triage and indexing.
+  with open_document(filename_or_stream) as doc:
+    props = parse_properties(doc.root['__properties_version1.0'], True, doc.root, doc)
+    msg = email.message.EmailMessage(policy=MESSAGE_POLICY)
+    add_headers(msg, props)
+    return msg
+
+
+def open_document(filename_or_stream, stream_attachments=False, zero_copy=False,
+    spill_threshold=None, rtf_cache=None, text_backfill="html2text", text_backfill_limit=None,
+    instrument=None, attachment_store=None, max_depth=None, max_embedded_bytes=None,
+    budget=None):
+  # Open a .msg file and return the compoundfiles.CompoundFileReader,
+  # with the conversion state and options that the functions below
+  # look for set as attributes on it.
+  #
+  # If stream_attachments is True, attachment content is left in the
+  # file to be streamed to the output (see convert()).
+  #
+  # If zero_copy is True and the file can be memory-mapped, stream
+  # content is returned by read_stream as memoryview slices of the
+  # mapped file instead of being copied, wherever the stream is
+  # stored in contiguous sectors.
+  #
+  # If spill_threshold is a number of bytes, attachments larger than
+  # that are not loaded into memory. They are copied to a temporary
+  # file (or, in zero-copy mode, kept as a view of the mapped file)
+  # and become AttachmentParts, which write_message encodes to its
+  # output in chunks.
+  #
+  # rtf_cache is an RtfCache to take RTF message bodies from and add
+  # them to, or None to not cache them.
+  #
+  # text_backfill says how to make a plain-text body for messages that
+  # only have an HTML body: "html2text", "fast" (strip_html), "none"
+  # (keep just the HTML body), or a function that takes the HTML and
+  # returns the text. HTML bodies longer than text_backfill_limit
+  # characters, if given, are always converted with "fast".
+  #
+  # instrument, if given, is called with the time taken by each stage
+  # of the conversion (see INSTRUMENTATION below).
+  #
+  # attachment_store is an AttachmentStore to put attachment content
+  # in, or None to keep it in the message.
+  #
+  # Attached messages are converted only when they are first needed
+  # (see EmbeddedMessagePart). Those nested more than max_depth levels
+  # deep, and those that would take the total size of the attached
+  # messages converted over max_embedded_bytes, are attached as .msg
+  # files (application/vnd.ms-outlook) instead.
+  #
+  # budget is a ResourceBudget to check the message against before
+  # any of it is read, or None for no limits.
+  import compoundfiles
+  started = time.perf_counter() if instrument is not None else None
+  doc = compoundfiles.CompoundFileReader(filename_or_stream)
+  doc.rtf_attachments = 0
+  doc.stream_attachments = stream_attachments
+  doc.mapped = map_document(doc) if zero_copy else None
+  doc.spill_threshold = spill_threshold
+  doc.rtf_cache = rtf_cache
+  doc.text_backfill = text_backfill
+  doc.text_backfill_limit = text_backfill_limit
+  doc.instrument = instrument
+  doc.attachment_store = attachment_store
+  doc.max_depth = max_depth
+  doc.max_embedded_bytes = max_embedded_bytes
+  doc.embedded_bytes = 0 # the size of the attached messages converted so far
+  doc.message_depth = 0
+  doc.message_path = ""
+  doc.budget = budget
+  if budget is not None:
+    try:
+      start_budget(doc, budget, started)
+    except:
+      doc.close()
+      raise
+  if started is not None:
+    report_stage(doc, "open", started, doc._file_size)
+  return doc
 
-    if 'DISPLAY_TO' in props:
-        if props['DISPLAY_TO']:
-            msg['To'] = props['DISPLAY_TO']
-        del props['DISPLAY_TO']
 
-    if 'DISPLAY_CC' in props:
-        if props['DISPLAY_CC']:
-            msg['CC'] = props['DISPLAY_CC']
-        del props['DISPLAY_CC']
+def load_message_stream(entry, is_top_level, doc):
+  message_started = time.perf_counter() if doc.instrument is not None else None
 
-    if 'DISPLAY_BCC' in props:
-        if props['DISPLAY_BCC']:
-            msg['BCC'] = props['DISPLAY_BCC']
-        del props['DISPLAY_BCC']
+  # Load stream data.
+  started = message_started
+  properties_stream = entry['__properties_version1.0']
+  props = parse_properties(properties_stream, is_top_level, entry, doc)
+  if started is not None:
+    report_stage(doc, "properties", started, properties_stream.size)
 
-    if 'SUBJECT' in props:
-        if props['SUBJECT']:
-            msg['Subject'] = props['SUBJECT']
-        del props['SUBJECT']
+  # Construct the MIME message....
+  msg = email.message.EmailMessage(policy=MESSAGE_POLICY)
+  add_headers(msg, props)
 
   # Add a plain text body from the BODY field.
   has_body = False
@@ -120,25 +278,44 @@ def load_message_stream(entry, is_top_level, doc):
 
   # Add a HTML body from the RTF_COMPRESSED field.
   if 'RTF_COMPRESSED' in props:
-    # Decompress the value to Rich Text Format.
-    import compressed_rtf
-    rtf = props['RTF_COMPRESSED']
-    rtf = compressed_rtf.decompress(rtf)
-
-    # Try rtfparse to de-encapsulate HTML stored in a rich
-    # text container.
+    rtf = None
     try:
-      rtf_blob = io.BytesIO(rtf)
-      parsed = Rtf_Parser(rtf_file=rtf_blob).parse_file()
-      html_stream = io.StringIO()
-      HTML_Decapsulator().render(parsed, html_stream)
-      html_body = html_stream.getvalue()
+      # Bodies already seen (in this message or an earlier one) are
+      # taken from the cache, if there is one.
+      cache_key = cached = None
+      if doc.rtf_cache is not None:
+        cache_key = doc.rtf_cache.key(props,
+          text_backfill_name(doc.text_backfill, doc.text_backfill_limit))
+        cached = doc.rtf_cache.get(cache_key)
+
+      if cached is None:
+        # Decompress the value to Rich Text Format.
+        started = time.perf_counter() if doc.instrument is not None else None
+        rtf = decompress_rtf(props['RTF_COMPRESSED'])
+        if started is not None:
+          started = report_stage(doc, "rtf_decompress", started, len(rtf))
+
+        # De-encapsulate HTML stored in a rich text container.
+        html_body = decapsulate_html(rtf)
+        if started is not None:
+          report_stage(doc, "rtf_decapsulate", started, len(html_body))
+        text_body = None
+      else:
+        html_body, text_body = cached
 
       if not has_body:
         # Try to convert that to plain/text if possible.
-        text_body = html2text.html2text(html_body)
-        msg.set_content(text_body, subtype="text", cte='quoted-printable')
-        has_body = True
+        if text_body is None:
+          started = time.perf_counter() if doc.instrument is not None else None
+          text_body = html_to_text(html_body, doc.text_backfill, doc.text_backfill_limit)
+          if started is not None:
+            report_stage(doc, "text_backfill", started, len(text_body or ""))
+        if text_body is not None:
+          msg.set_content(text_body, subtype="text", cte='quoted-printable')
+          has_body = True
+
+      if cache_key is not None and (cached is None or cached[1] != text_body):
+        doc.rtf_cache.put(cache_key, html_body, text_body)
 
       if not has_body:
         msg.set_content(html_body, subtype="html", cte='quoted-printable')
@@ -148,6 +325,8 @@ def load_message_stream(entry, is_top_level, doc):
 
     # If that fails, just attach the RTF file to the message.
     except:
+      if rtf is None:
+        rtf = decompress_rtf(props['RTF_COMPRESSED'])
       doc.rtf_attachments += 1
       fn = "messagebody_{}.rtf".format(doc.rtf_attachments)
 
@@ -176,36 +355,252 @@ def load_message_stream(entry, is_top_level, doc):
   for stream in entry:
     if stream.name.startswith("__attach_version1.0_#"):
       try:
-        process_attachment(msg, stream, doc)
+        if doc.budget is not None and not within_budget(doc, stream):
+          omit_attachment(msg, stream, doc)
+        elif doc.instrument is None:
+          process_attachment(msg, stream, doc)
+        else:
+          instrumented_process_attachment(msg, stream, doc)
       except KeyError as e:
         logger.error("Error processing attachment {} not found".format(str(e)))
         continue
 
+  if message_started is not None:
+    report_stage(doc, "message", message_started)
+
   return msg
 
 
+def add_headers(msg, props):
+  # Add headers to msg from the message properties props.
+
+  # Add the raw headers, if known.
+  if 'TRANSPORT_MESSAGE_HEADERS' in props:
+    # Get the string holding all of the headers.
+    headers = props['TRANSPORT_MESSAGE_HEADERS']
+    if isinstance(headers, bytes):
+      headers = headers.decode("utf-8")
+
+    # Copy them into the message object as they are, the way the
+    # email parser stores them (they are parsed if they are looked
+    # at), except for the Content-Type family of headers, because the
+    # body we can get this way is just the plain-text portion of the
+    # email and whatever Content-Type header was in the original is
+    # not valid for reconstructing it this way. Headers that aren't
+    # ASCII are encoded (see encode_header).
+    for header, value in split_headers(headers):
+      if header.lower().startswith("content-"):
+        continue
+      if not value.isascii():
+        value = encode_header(msg.policy, header, value)
+      msg.set_raw(header, value)
+
+  else:
+    # Construct common headers from metadata.
+
+    if 'MESSAGE_DELIVERY_TIME' in props:
+        msg['Date'] = formatdate(props['MESSAGE_DELIVERY_TIME'].timestamp())
+        del props['MESSAGE_DELIVERY_TIME']
+
+    if 'SENDER_NAME' in props:
+        if 'SENT_REPRESENTING_NAME' in props:
+            if props['SENT_REPRESENTING_NAME']:
+                if props['SENDER_NAME'] != props['SENT_REPRESENTING_NAME']:
+                  props['SENDER_NAME'] += " (" + props['SENT_REPRESENTING_NAME'] + ")"
+            del props['SENT_REPRESENTING_NAME']
+        if props['SENDER_NAME']:
+            msg['From'] = formataddr((props['SENDER_NAME'], ""))
+        del props['SENDER_NAME']
+
+    if 'DISPLAY_TO' in props:
+        if props['DISPLAY_TO']:
+            msg['To'] = props['DISPLAY_TO']
+        del props['DISPLAY_TO']
+
+    if 'DISPLAY_CC' in props:
+        if props['DISPLAY_CC']:
+            msg['CC'] = props['DISPLAY_CC']
+        del props['DISPLAY_CC']
+
+    if 'DISPLAY_BCC' in props:
+        if props['DISPLAY_BCC']:
+            msg['BCC'] = props['DISPLAY_BCC']
+        del props['DISPLAY_BCC']
+
+    if 'SUBJECT' in props:
+        if props['SUBJECT']:
+            msg['Subject'] = props['SUBJECT']
+        del props['SUBJECT']
+
+
+# The start of a line that begins a header field, and its name.
+HEADER_FIELD = re.compile(r"([\041-\071\073-\176]*):")
+
+# A line break in raw headers.
+HEADER_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+def split_headers(headers):
+  # Return a list of (name, value) tuples of the header fields in a
+  # string of raw headers, in one pass over it. Each value is the
+  # field's text after the colon, with leading spaces removed and any
+  # continuation lines kept, as the email parser stores it. The fields
+  # end where the email parser's do: at a blank line or another line
+  # that can't be part of a header. Lines beginning "From " and fields
+  # with no name are skipped.
+  fields = []
+  name = None
+  value = []
+  for line in HEADER_LINE_BREAK.split(headers):
+    if line[:1] in (" ", "\t"):
+      # A continuation line, which is dropped if the previous line
+      # wasn't part of a field.
+      if name is not None:
+        value.append(line)
+      continue
+    if name is not None:
+      fields.append((name, "\n".join(value)))
+      name = None
+    if line.startswith("From "):
+      continue
+    m = HEADER_FIELD.match(line)
+    if m is None:
+      break
+    if m.end() > 1:
+      name = m.group(1)
+      value = [line[m.end():].lstrip(" \t")]
+  if name is not None:
+    fields.append((name, "\n".join(value)))
+  return fields
+
+
+def encode_header(policy, header, value):
+  # Return the value of a header field that isn't ASCII in a form
+  # that is, for msg.set_raw. In unstructured fields (such as Subject)
+  # the words that aren't ASCII are encoded, and in address fields the
+  # display names, both in time linear in the length of the value.
+  # Other structured fields, where quoted strings and comments can't
+  # just be encoded, are parsed and encoded by the email library.
+  import email.headerregistry
+  header_class = policy.header_factory.registry.get(header.lower(),
+    policy.header_factory.default_class)
+  if issubclass(header_class, email.headerregistry.UnstructuredHeader):
+    return encode_header_words(value)
+  if issubclass(header_class, email.headerregistry.AddressHeader):
+    addresses = encode_addresses(value)
+    if addresses is not None:
+      return addresses
+  return policy.header_fetch_parse(header, value)
+
+
+def encode_addresses(value):
+  # Return the value of an address field with its display names
+  # (taken out of their quoted strings or comments) encoded as RFC
+  # 2047 encoded words, one address to a line, or None if it has an
+  # address that isn't ASCII or can't be parsed.
+  from email.utils import getaddresses
+  out = []
+  for name, address in getaddresses([value.replace("\n", "")]):
+    if not address or not address.isascii():
+      return None
+    if name.isascii():
+      out.append(formataddr((name, address)))
+    else:
+      out.append("{} <{}>".format(encode_words(name), address))
+  return ",\n ".join(out)
+
+
+# Whitespace in a header field's value, and the words between it.
+HEADER_WHITESPACE = re.compile(r"(\s+)")
+
+def encode_header_words(value):
+  # Return a header field's value with each run of words that aren't
+  # ASCII replaced by RFC 2047 encoded words (=?utf-8?b?...?=), one
+  # to a line, in one pass over it. The rest of the value, including
+  # its line breaks, is kept as it is. (The email library's parsing
+  # and refolding of the value would take time that grows faster than
+  # its length.)
+  lines = []
+  for line in value.split("\n"):
+    # Split the line into words and the whitespace between them, and
+    # collect each run of words that aren't ASCII (with the whitespace
+    # between them, which is not kept between encoded words).
+    out = []
+    run = []
+    for token in HEADER_WHITESPACE.split(line) + [""]:
+      if not token.isascii() or (run and token.isspace()):
+        run.append(token)
+        continue
+      if run:
+        space = run.pop() if run[-1].isspace() else ""
+        out.append(encode_words("".join(run)))
+        out.append(space)
+        run = []
+      out.append(token)
+    lines.append("".join(out))
+  return "\n".join(lines)
+
+
+def encode_words(text):
+  # Return text as RFC 2047 encoded words on continuation lines, each
+  # holding at most 45 bytes of UTF-8 (so at most 75 characters), not
+  # splitting characters between words.
+  data = text.encode("utf-8", "replace")
+  words = []
+  i = 0
+  while i < len(data):
+    j = min(i + 45, len(data))
+    while j < len(data) and (data[j] & 0xC0) == 0x80:
+      j -= 1
+    words.append("=?utf-8?b?" + base64.b64encode(data[i:j]).decode("ascii") + "?=")
+    i = j
+  return "\n ".join(words)
+
+
 def process_attachment(msg, entry, doc):
   # Load attachment stream.
   props = parse_properties(entry['__properties_version1.0'], False, entry, doc)
 
-  # The attachment content...
-  blob = props['ATTACH_DATA_BIN']
+  # The attachment content... When streaming, it is left in the
+  # .msg file and copied to the output by write_message (see
+  # convert()). A large attachment may also be kept out of memory
+  # until the message is written (see open_document), or be put
+  # in an attachment store.
+  opener = None
+  stored = None
+  embedded = props.raw_stream('ATTACH_DATA_BIN', EMBEDDED_MESSAGE)
+  entity = props.raw_stream('ATTACH_DATA_BIN')
+  if entity is not None:
+    store = doc.attachment_store
+    if store is not None and entity.size >= store.min_size:
+      stored = store.put(lambda: open_stream(doc, entity))
+    elif doc.stream_attachments:
+      opener = lambda: open_stream(doc, entity)
+    elif doc.spill_threshold is not None and entity.size > doc.spill_threshold:
+      opener = spill_stream(doc, entity)
+  blob = props['ATTACH_DATA_BIN'] if opener is None and stored is None and embedded is None \
+    else None
 
   # Get the filename and MIME type of the attachment.
-  filename = props.get("ATTACH_LONG_FILENAME") or props.get("ATTACH_FILENAME") or props.get("DISPLAY_NAME")
-  if isinstance(filename, bytes): filename = filename.decode("utf8")
+  filename = attachment_filename(props)
 
   mime_type = props.get('ATTACH_MIME_TAG', 'application/octet-stream')
   if isinstance(mime_type, bytes): mime_type = mime_type.decode("utf8")
 
-  filename = os.path.basename(filename)
-
-  # Python 3.6.
-  if isinstance(blob, str):
+  if embedded is not None:
+    add_embedded_message(msg, embedded, doc, filename)
+  elif stored is not None:
+    add_stored_attachment(msg, *stored,
+      maintype=mime_type.split("/", 1)[0], subtype=mime_type.split("/", 1)[-1],
+      filename=filename)
+  elif opener is not None:
+    add_streamed_attachment(msg, opener,
+      maintype=mime_type.split("/", 1)[0], subtype=mime_type.split("/", 1)[-1],
+      filename=filename)
+  elif isinstance(blob, str):
     msg.add_attachment(
       blob,
       filename=filename)
-  elif isinstance(blob, bytes):
+  elif isinstance(blob, (bytes, memoryview)):
     msg.add_attachment(
       blob,
       maintype=mime_type.split("/", 1)[0], subtype=mime_type.split("/", 1)[-1],
@@ -215,80 +610,76 @@ def process_attachment(msg, entry, doc):
       blob,
       filename=filename)
 
-def parse_properties(properties, is_top_level, container, doc):
-  # Read a properties stream and return a Python dictionary
+def attachment_filename(props):
+  # Return the filename of an attachment from its properties.
+  filename = props.get("ATTACH_LONG_FILENAME") or props.get("ATTACH_FILENAME") or props.get("DISPLAY_NAME")
+  if isinstance(filename, bytes): filename = filename.decode("utf8")
+  return os.path.basename(filename)
+
+
+def omit_attachment(msg, entry, doc):
+  # Add a short text attachment to msg in place of the attachment in
+  # entry, which is left out of a conversion that is over its budget.
+  props = parse_properties(entry['__properties_version1.0'], False, entry, doc)
+  filename = attachment_filename(props)
+  msg.add_attachment(
+    "<attachment {} omitted: the message is over its conversion budget>".format(filename),
+    filename=filename + ".omitted.txt")
+
+
+def parse_properties(properties, is_top_level, container, doc, header_size=None):
+  # Read a properties stream and return a dictionary-like object
   # of the fields and values, using human-readable field names
-  # in the mapping at the top of this module.
+  # in the mapping at the top of this module. Only the fixed-length
+  # values stored in the properties stream itself are decoded here.
+  # The streams holding variable-length values are read and decoded
+  # when their field is first accessed (see LazyProperties).
+  #
+  # header_size, if given, is the size of the header before the
+  # entries, overriding the size for a top-level or other message.
 
   # Load stream content.
-  with doc.open(properties) as stream:
-    stream = stream.read()
+  stream = read_stream(doc, properties)
 
   # Skip header.
-  i = (32 if is_top_level else 24)
-
-  # Read 16-byte entries.
-  raw_properties = { }
-  while i < len(stream):
-    # Read the entry.
-    property_type  = stream[i+0:i+2]
-    property_tag = stream[i+2:i+4]
-    flags = stream[i+4:i+8]
-    value = stream[i+8:i+16]
-    i += 16
-
-    # Turn the byte strings into numbers and look up the property type.
-    property_type = property_type[0] + (property_type[1]<<8)
-    property_tag = property_tag[0] + (property_tag[1]<<8)
-    if property_tag not in property_tags: continue # should not happen
-    tag_name, _ = property_tags[property_tag]
+  i = (32 if is_top_level else 24) if header_size is None else header_size
+
+  # Read 16-byte entries, all at once. Each is a two-byte property
+  # type, a two-byte property tag, four bytes of flags, and eight
+  # bytes holding either a fixed-length value or the length of a
+  # variable-length value. A truncated final entry is ignored.
+  end = i + (len(stream) - i) // PROPERTY_ENTRY.size * PROPERTY_ENTRY.size
+  properties = { } # decoded fixed-length values
+  raw_properties = { } # variable-length values to load later
+  for property_type, property_tag, flags, value in \
+      PROPERTY_ENTRY.iter_unpack(memoryview(stream)[i:end]):
+    # Look up the property type.
+    tag = property_tags.get(property_tag)
+    if tag is None: continue # should not happen
+    tag_name = tag[0]
     tag_type = property_types.get(property_type)
 
-    # Fixed Length Properties.
+    # Fixed Length Properties. Decode them now so we have codepage
+    # properties.
     if isinstance(tag_type, FixedLengthValueLoader):
       # The value comes from the stream above.
-      pass
-
-    # Variable Length Properties.
-    elif isinstance(tag_type, VariableLengthValueLoader):
-      value_length = stream[i+8:i+12] # not used
-
-      # Look up the stream in the document that holds the value.
-      streamname = "__substg1.0_{0:0{1}X}{2:0{3}X}".format(property_tag,4, property_type,4)
-      try:
-        with doc.open(container[streamname]) as innerstream:
-          value = innerstream.read()
-      except:
-        # Stream isn't present!
-        logger.error("stream missing {}".format(streamname))
-        continue
-
-    elif isinstance(tag_type, EMBEDDED_MESSAGE):
-      # Look up the stream in the document that holds the attachment.
-      streamname = "__substg1.0_{0:0{1}X}{2:0{3}X}".format(property_tag,4, property_type,4)
+      raw_properties.pop(tag_name, None)
       try:
-        value = container[streamname]
-      except:
-        # Stream isn't present!
-        logger.error("stream missing {}".format(streamname))
-        continue
+        properties[tag_name] = tag_type.load(value)
+      except Exception as e:
+        properties.pop(tag_name, None)
+        logger.error("Error while reading stream: {}".format(str(e)))
+
+    # Variable Length Properties and embedded messages.
+    elif isinstance(tag_type, (VariableLengthValueLoader, EMBEDDED_MESSAGE)):
+      # The value is in another stream in the document, which
+      # is read only if the property is accessed.
+      properties.pop(tag_name, None)
+      raw_properties[tag_name] = (tag_type, (property_tag, property_type))
 
     else:
       # unrecognized type
       logger.error("unhandled property type {}".format(hex(property_type)))
-      continue
-
-    raw_properties[tag_name] = (tag_type, value)
-
-  # Decode all FixedLengthValueLoader properties so we have codepage
-  # properties.
-  properties = { }
-  for tag_name, (tag_type, value) in raw_properties.items():
-    if not isinstance(tag_type, FixedLengthValueLoader): continue
-    try:
-      properties[tag_name] = tag_type.load(value)
-    except Exception as e:
-      logger.error("Error while reading stream: {}".format(str(e)))
 
   # String8 strings use code page information stored in other
   # properties, which may not be present. Find the Python
@@ -304,27 +695,1844 @@ def parse_properties(properties, is_top_level, container, doc):
   if "PR_MESSAGE_CODEPAGE" in properties and properties['PR_MESSAGE_CODEPAGE'] in code_pages:
     properties_encoding = code_pages[properties['PR_MESSAGE_CODEPAGE']]
 
-  # Decode all of the remaining properties.
-  for tag_name, (tag_type, value) in raw_properties.items():
-    if isinstance(tag_type, FixedLengthValueLoader): continue # already done, above
+  return LazyProperties(properties, raw_properties, container, doc,
+    body_encoding, properties_encoding)
+
+
+class LazyProperties(collections.abc.MutableMapping):
+  # A dictionary of property names to values in which the values of
+  # variable-length properties and embedded messages are read from
+  # their streams and decoded the first time they are accessed, and
+  # then remembered. A property whose stream is missing or can't be
+  # decoded is logged and treated as not present, so "in" and get()
+  # also load the value. Iterating loads every value.
+
+  def __init__(self, values, pending, container, doc, body_encoding, properties_encoding):
+    self._values = values # decoded values
+    self._pending = pending # tag name => (tag type, (property tag, property type))
+    self._container = container
+    self._streams = None # the container's stream_index, once needed
+    self._doc = doc
+    self._body_encoding = body_encoding
+    self._properties_encoding = properties_encoding
+
+  def __getitem__(self, tag_name):
+    if tag_name in self._values:
+      return self._values[tag_name]
+    if tag_name not in self._pending:
+      raise KeyError(tag_name)
+    tag_type, stream_key = self._pending.pop(tag_name)
+    self._values[tag_name] = self._load(tag_name, tag_type, stream_key)
+    return self._values[tag_name]
+
+  def _stream(self, stream_key):
+    # Return the stream or storage in the container that holds the
+    # value of a property, given its (property tag, property type),
+    # or None if there isn't one.
+    if self._streams is None:
+      self._streams = stream_index(self._container)
+    return self._streams.get(stream_key)
+
+  def _load(self, tag_name, tag_type, stream_key):
+    # Look up the stream in the document that holds the value.
+    value = self._stream(stream_key)
+    if value is None:
+      # Stream isn't present!
+      logger.error("stream missing __substg1.0_%04X%04X" % stream_key)
+      raise KeyError(tag_name)
+
+    if isinstance(tag_type, VariableLengthValueLoader):
+      value = read_stream(self._doc, value)
 
     # The codepage properties may be wrong. Fall back to
     # the other property if present.
-    encodings = [body_encoding, properties_encoding] if tag_name == "BODY" \
-      else [properties_encoding, body_encoding]
+    encodings = [self._body_encoding, self._properties_encoding] if tag_name == "BODY" \
+      else [self._properties_encoding, self._body_encoding]
 
     try:
-      properties[tag_name] = tag_type.load(value, encodings=encodings, doc=doc)
+      return tag_type.load(value, encodings=encodings, doc=self._doc)
     except KeyError as e:
       logger.error("Error while reading stream: {} not found".format(str(e)))
     except Exception as e:
       logger.error("Error while reading stream: {}".format(str(e)))
+    raise KeyError(tag_name)
+
+  def __contains__(self, tag_name):
+    try:
+      self[tag_name]
+      return True
+    except KeyError:
+      return False
+
+  def __setitem__(self, tag_name, value):
+    self._pending.pop(tag_name, None)
+    self._values[tag_name] = value
+
+  def __delitem__(self, tag_name):
+    if tag_name in self._pending:
+      del self._pending[tag_name]
+    else:
+      del self._values[tag_name]
+
+  def __iter__(self):
+    for tag_name in list(self._pending):
+      tag_name in self # load it
+    return iter(self._values)
+
+  def __len__(self):
+    return len(list(iter(self)))
+
+  def names(self):
+    # Return a list of the property names, without loading any values.
+    return list(self._values) + list(self._pending)
+
+  def raw_stream(self, tag_name, loader=None):
+    # Return the document entity for the stream holding a BINARY
+    # property's value (or the storage holding an embedded message,
+    # if loader is EMBEDDED_MESSAGE) without reading it, or None if
+    # the property isn't present, is of another type, or has
+    # already been loaded.
+    if tag_name not in self._pending:
+      return None
+    tag_type, stream_key = self._pending[tag_name]
+    if not isinstance(tag_type, loader or BINARY):
+      return None
+    return self._stream(stream_key)
+
+
+# The name of a stream or storage holding a property value, with the
+# property tag and type in hex.
+SUBSTREAM_NAME = re.compile(r"__substg1\.0_([0-9A-F]{4})([0-9A-F]{4})\Z", re.I)
+
+def stream_index(container):
+  # Return a dict mapping (property tag, property type) to the streams
+  # and storages in container that hold property values, so that each
+  # is found without formatting its name or looking it up among the
+  # container's children by name, which compoundfiles does one by one.
+  # As with lookups by name, the first of any with the same name wins.
+  index = { }
+  for child in container:
+    m = SUBSTREAM_NAME.match(child.name)
+    if m:
+      index.setdefault((int(m.group(1), 16), int(m.group(2), 16)), child)
+  return index
+
+
+# PROPERTY EXTRACTION
+
+# For indexing, extract_properties() returns the decoded properties of
+# a message without building a MIME message: as a dict that can be
+# written as JSON, holding the properties of the message, of its
+# recipients and of its attachments, and those of attached messages.
+# Attachment content and other large BINARY values are not read.
+
+# The size of the header of the properties stream of a top-level
+# message, an embedded message, and an attachment or recipient
+# ([MS-OXMSG] 2.4).
+TOP_LEVEL_HEADER_SIZE = 32
+EMBEDDED_MESSAGE_HEADER_SIZE = 24
+SUBOBJECT_HEADER_SIZE = 8
+
+
+def extract_properties(filename_or_stream, zero_copy=False, max_binary=1024):
+  # Return a dict of the properties of a .msg file:
+  #
+  #   "properties"   the message's properties by name (see json_value)
+  #   "omitted"      the sizes of the BINARY properties longer than
+  #                  max_binary bytes, which are left out unread
+  #   "recipients"   a list of each recipient's "properties" and
+  #                  "omitted"
+  #   "attachments"  a list of each attachment's "properties" and
+  #                  "omitted", and either the "size" of its content
+  #                  (which isn't read) or, for an attached message,
+  #                  the same dict for the "message" (with "size" None)
+  with open_document(filename_or_stream, zero_copy=zero_copy) as doc:
+    return extract_message_stream(doc.root, TOP_LEVEL_HEADER_SIZE, doc, max_binary)
+
+
+def extract_message_stream(entry, header_size, doc, max_binary):
+  result = extract_object(entry, header_size, doc, max_binary)
+  result["recipients"] = []
+  result["attachments"] = []
+  for stream in entry:
+    if stream.name.startswith("__recip_version1.0_#"):
+      result["recipients"].append(extract_object(stream, SUBOBJECT_HEADER_SIZE, doc, max_binary))
+    elif stream.name.startswith("__attach_version1.0_#"):
+      attachment = extract_object(stream, SUBOBJECT_HEADER_SIZE, doc, max_binary)
+      attachment.setdefault("size", None)
+      result["attachments"].append(attachment)
+  return result
+
+
+def extract_object(entry, header_size, doc, max_binary):
+  # Return the "properties" and "omitted" dicts of a message,
+  # recipient or attachment, and the "size" of an attachment's
+  # content or its attached "message".
+  props = parse_properties(entry['__properties_version1.0'], False, entry, doc,
+    header_size=header_size)
+  result = { "properties": { }, "omitted": { } }
+  for tag_name in props.names():
+    embedded = props.raw_stream(tag_name, EMBEDDED_MESSAGE)
+    if embedded is not None:
+      result["message"] = extract_message_stream(embedded, EMBEDDED_MESSAGE_HEADER_SIZE, doc,
+        max_binary)
+      continue
+    entity = props.raw_stream(tag_name)
+    if entity is not None and tag_name == "ATTACH_DATA_BIN":
+      result["size"] = entity.size
+    elif entity is not None and entity.size > max_binary:
+      result["omitted"][tag_name] = entity.size
+    elif tag_name in props:
+      result["properties"][tag_name] = json_value(props[tag_name])
+  return result
+
+
+def json_value(value):
+  # Return a property value as a value that json can write: BINARY
+  # values as base64 text, and times in ISO 8601 format (in UTC).
+  if isinstance(value, (bytes, memoryview)):
+    return base64.b64encode(value).decode("ascii")
+  if isinstance(value, datetime):
+    return value.isoformat() + "Z"
+  return value
+
+
+# RTF DE-ENCAPSULATION
+
+# Outlook stores HTML message bodies as RTF with the original HTML
+# encapsulated in it (\\fromhtml1 RTF, see [MS-OXRTFEX]). The
+# scanner below extracts the HTML in a single regular-expression
+# pass. It reproduces exactly what rtfparse's Rtf_Parser and
+# HTML_Decapsulator produce, quirks included, so that output doesn't
+# depend on which was used. Anything the scanner isn't sure to treat
+# the same way as rtfparse, and RTF that isn't encapsulated HTML,
+# goes through rtfparse instead.
+
+# The RTF tokens the scanner reads (a pattern, compiled on first use).
+RTF_TOKEN = (
+  rb"(?P<text>[^\\{}\r\n]+)"
+  rb"|\{\\\*\\htmltag[0-9]{1,10}(?: |\r\n)?(?P<htmltag>[^\\{}\r\n]*)\}"
+  rb"|\\(?P<word>[a-zA-Z]{1,32})(?P<param>-?[0-9]{1,10})?(?: |\r\n)?"
+  rb"|\\'(?P<hex>[0-9a-fA-F]{2})"
+  rb"|\\(?P<symbol>[^a-zA-Z0-9])"
+  rb"|(?P<open>\{)(?:\\\*)?"
+  rb"|(?P<close>\})")
+
+# How rtfparse's HTML_Decapsulator renders control symbols.
+RTF_SYMBOLS = { "|": "", "~": "\u00a0", "-": "", "_": "\u2011", ":": "", "*": "" }
+
+# Groups that HTML_Decapsulator does not render, by their first control word.
+RTF_IGNORED_GROUPS = ("fonttbl", "colortbl", "generator", "formatConverter", "pntext", "pntxta", "pntxtb")
+
+# Code pages in which each byte is one character, so that decoding
+# a run of text doesn't depend on where rtfparse splits it.
+RTF_SINGLE_BYTE_ENCODINGS = ("cp1250", "cp1251", "cp1252", "cp1253", "cp1254", "cp1255",
+  "cp1256", "cp1257", "cp1258", "cp437", "cp850", "mac_roman")
+
+
+def decompress_rtf(rtf_compressed):
+  # Decompress an RTF_COMPRESSED property value to RTF.
+  import compressed_rtf
+  return compressed_rtf.decompress(rtf_compressed)
+
+
+def decapsulate_html(rtf):
+  # Return the HTML encapsulated in RTF (as a str), using the fast
+  # scanner if possible and rtfparse otherwise.
+  html = _scan_encapsulated_html(rtf)
+  if html is None:
+    from rtfparse.parser import Rtf_Parser
+    from rtfparse.renderers.html_decapsulator import HTML_Decapsulator
+    parsed = Rtf_Parser(rtf_file=io.BytesIO(rtf)).parse_file()
+    html_stream = io.StringIO()
+    HTML_Decapsulator().render(parsed, html_stream)
+    html = html_stream.getvalue()
+  return html
+
+
+def _rtf_control_word(m):
+  # Return the name and parameter of a control word the way
+  # rtfparse does, which drops the parameter from the name only
+  # if it is written in canonical form.
+  name, param = m.group("word").decode("ascii"), m.group("param")
+  if param is None:
+    return name, ""
+  param_str = param.decode("ascii")
+  param = int(param_str)
+  return (name + param_str).removesuffix(str(param)), param
+
+
+def _rtf_encoding(rtf):
+  # Determine the text encoding like rtfparse does, from the control
+  # words at the top level of the first 48 bytes. Returns None if
+  # rtfparse would fail.
+  names = []
+  depth = 0
+  pos = 0
+  probe = rtf[:48]
+  try:
+    probe.decode("cp1252") # rtfparse reads the probe as cp1252
+  except UnicodeDecodeError:
+    return None
+  match = re.compile(RTF_TOKEN).match
+  while pos < len(probe):
+    m = match(probe, pos)
+    if m is None:
+      pos += 1
+      continue
+    pos = m.end()
+    if m.group("open"):
+      depth += 1
+    elif m.group("close"):
+      depth -= 1
+      if depth == 0:
+        break
+    elif m.group("word") and depth == 1:
+      name, param = _rtf_control_word(m)
+      if name in ("ansi", "ansicpg", "mac", "pc", "pca"):
+        names.append((name, param))
+    elif m.group("hex") or m.group("symbol") == b"'":
+      return None
+  if not names:
+    return None
+  param = names[-1][1] or None
+  if param:
+    return "cp1252" if param == 65001 else "cp{}".format(param)
+  return { "ansi": "cp1252", "mac": "mac_roman", "pc": "cp437", "pca": "cp850" }.get(names[0][0])
+
+
+def _scan_encapsulated_html(rtf):
+  # Extract encapsulated HTML from RTF in one pass, or return None
+  # if the RTF isn't \\fromhtml1 RTF or has anything that the scanner
+  # isn't sure to render exactly like rtfparse.
+  rtf = bytes(rtf)
+  if not rtf.startswith(b"{\\rtf"):
+    return None
+  encoding = _rtf_encoding(rtf)
+  if encoding not in RTF_SINGLE_BYTE_ENCODINGS:
+    return None
+
+  out = []
+  is_html = False
+  ignore_rtf = False # \\htmlrtf, which rtfparse doesn't scope to groups
+  depth = 0 # group nesting depth
+  skip_depth = None # depth of the unrendered group we are in, if any
+  name_pending = False # the next token names the group just opened
+  match = re.compile(RTF_TOKEN).match
+  pos = 0
+  end = len(rtf)
+  try:
+    while pos < end:
+      m = match(rtf, pos)
+      if m is None:
+        # Line breaks and stray backslashes are skipped.
+        pos += 1
+        continue
+      pos = m.end()
+      kind = m.lastgroup
+
+      if name_pending:
+        name_pending = False
+        if kind in ("word", "param") and skip_depth is None \
+            and _rtf_control_word(m)[0] in RTF_IGNORED_GROUPS:
+          skip_depth = depth
+
+      if kind == "open":
+        depth += 1
+        name_pending = True
+      elif kind == "close":
+        if skip_depth == depth:
+          skip_depth = None
+        depth -= 1
+        if depth == 0:
+          break # end of the document
+      elif kind in ("word", "param"):
+        name, param = _rtf_control_word(m)
+        if name == "bin":
+          return None
+        if skip_depth is not None:
+          continue
+        if name == "htmlrtf":
+          if param == "" or param == 1:
+            ignore_rtf = True
+          elif param == 0:
+            ignore_rtf = False
+        elif name == "fromhtml" and depth == 1 and param == 1:
+          is_html = True
+        elif name in ("par", "line") and not ignore_rtf:
+          out.append("\n")
+        elif name == "tab" and not ignore_rtf:
+          out.append("\t")
+      elif kind == "hex":
+        text = bytes((int(m.group("hex"), 16),)).decode(encoding)
+        if text in "\\{}":
+          # rtfparse reads the two hex digits again as text.
+          pos -= 2
+        if skip_depth is None and not ignore_rtf:
+          out.append(RTF_SYMBOLS.get(text, text))
+      elif kind == "symbol":
+        text = chr(m.group("symbol")[0])
+        if text == "'":
+          return None # not followed by two hex digits
+        if skip_depth is None and not ignore_rtf:
+          out.append(RTF_SYMBOLS.get(text, text))
+      else: # text, or a whole {\\*\\htmltag} group holding only text
+        text = m.group(kind).decode(encoding)
+        if skip_depth is None and not ignore_rtf:
+          out.append(text)
+  except UnicodeDecodeError:
+    return None
+
+  if not is_html:
+    return None
+  return "".join(out)
+
+
+# TEXT BACKFILL
+
+
+def _html2text(html):
+  import html2text
+  return html2text.html2text(html)
+
+
+def strip_html(html):
+  # Return the text of html with the tags removed, with line breaks
+  # for line breaks and block elements and whitespace collapsed as
+  # a browser would. This is much faster than html2text on large
+  # bodies but keeps none of the formatting (emphasis, lists, links).
+  parser = _html_text_extractor()
+  parser.feed(html)
+  parser.close()
+  text = "".join(parser.text)
+  text = re.sub(r" {2,}", " ", text)
+  text = re.sub(r" *\n *", "\n", text)
+  text = re.sub(r"\n{3,}", "\n\n", text)
+  return text.strip(" \n") + "\n"
+
+
+_HTMLTextExtractor = None
+
+def _html_text_extractor():
+  # Return a parser that collects the text of an HTML document for
+  # strip_html. The class is made on first use so that html.parser
+  # is only imported if it's needed.
+  global _HTMLTextExtractor
+  if _HTMLTextExtractor is None:
+    import html.parser
+
+    class HTMLTextExtractor(html.parser.HTMLParser):
+      BLOCK_TAGS = frozenset(("address", "article", "aside", "blockquote", "dd", "div", "dl", "dt",
+        "fieldset", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr",
+        "li", "main", "nav", "ol", "p", "pre", "section", "table", "tr", "ul"))
+      HIDDEN_TAGS = frozenset(("head", "script", "style", "title", "template"))
+      WHITESPACE = re.compile(r"[ \t\n\r\f]+")
+
+      def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = []
+        self.hidden = 0
+
+      def handle_starttag(self, tag, attrs):
+        if tag in self.HIDDEN_TAGS:
+          self.hidden += 1
+        elif tag == "br":
+          self.text.append("\n")
+        elif tag in self.BLOCK_TAGS:
+          self.text.append("\n\n" if tag == "p" else "\n")
+        elif tag in ("td", "th"):
+          self.text.append(" ")
+
+      def handle_endtag(self, tag):
+        if tag in self.HIDDEN_TAGS:
+          self.hidden = max(0, self.hidden - 1)
+        elif tag in self.BLOCK_TAGS:
+          self.text.append("\n\n" if tag == "p" else "\n")
+
+      def handle_data(self, data):
+        if not self.hidden:
+          self.text.append(self.WHITESPACE.sub(" ", data))
+
+    _HTMLTextExtractor = HTMLTextExtractor
+  return _HTMLTextExtractor()
+
+
+# When a message has an HTML body but no plain-text body, a plain-text
+# body is made from the HTML by one of these functions, chosen by the
+# text_backfill option (or a function passed as text_backfill). "none"
+# leaves the message with just the HTML body.
+TEXT_BACKFILLS = {
+  "html2text": _html2text,
+  "fast": strip_html,
+  "none": None,
+}
+
+
+def html_to_text(html, text_backfill="html2text", limit=None):
+  # Return the plain-text rendering of html, or None if text_backfill
+  # is "none". If limit is a number of characters and html is longer
+  # than that, the fast tag stripper is used instead of a slower
+  # text_backfill.
+  if callable(text_backfill):
+    fn = text_backfill
+  else:
+    fn = TEXT_BACKFILLS[text_backfill]
+  if fn is None:
+    return None
+  if limit is not None and len(html) > limit:
+    fn = TEXT_BACKFILLS["fast"]
+  return fn(html)
+
+
+def text_backfill_name(text_backfill, limit=None):
+  # Return a string that identifies the text_backfill and limit
+  # options of html_to_text, for keying cached output.
+  if callable(text_backfill):
+    text_backfill = "{}.{}".format(text_backfill.__module__, text_backfill.__qualname__)
+  if limit is not None and text_backfill != "none":
+    text_backfill += "-{}".format(limit)
+  return text_backfill
+
+
+# ATOMIC FILE WRITES
+
+class _DiscardWrite(Exception):
+  # Raised in an _atomic_write context to throw away what was written.
+  pass
+
+
+@contextlib.contextmanager
+def _atomic_write(path, temp_dir=None):
+  # Return a context manager that gives a binary file to write the
+  # content of path to. The file is written under a temporary name in
+  # temp_dir (by default path's directory, which is created if it is
+  # missing) and moved to path when the context exits, so that other
+  # processes never see a partly written file. If the context exits
+  # with an exception, the temporary file is removed instead (and a
+  # _DiscardWrite exception is not raised any further).
+  import tempfile
+  if temp_dir is None:
+    temp_dir = os.path.dirname(path) or "."
+    os.makedirs(temp_dir, exist_ok=True)
+  fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+    dir=temp_dir)
+  try:
+    with open(fd, "wb") as f:
+      yield f
+    os.replace(temp_path, path)
+  except BaseException as e:
+    try:
+      os.unlink(temp_path)
+    except OSError:
+      pass
+    if not isinstance(e, _DiscardWrite):
+      raise
+
+
+# RTF BODY CACHE
+
+def _without_lock(obj):
+  # Return a copy of an object's __dict__ without its lock, which
+  # can't be pickled, for __getstate__.
+  state = obj.__dict__.copy()
+  del state["_lock"]
+  return state
+
+
+def _set_state_with_lock(obj, state):
+  # Restore an object pickled with _without_lock, with a new lock.
+  obj.__dict__.update(state)
+  obj._lock = threading.Lock()
+
+
+def _counters(obj):
+  # Return a dict of the stats counters of a cache or attachment
+  # store (named by its COUNTERS), so that the counts of copies of it
+  # in worker processes can be added to it with _add_counters.
+  with obj._lock:
+    return { name: getattr(obj, name) for name in obj.COUNTERS }
+
+
+def _add_counters(obj, counts):
+  with obj._lock:
+    for name, count in counts.items():
+      setattr(obj, name, getattr(obj, name) + count)
+
+
+class RtfCache(object):
+  # A cache of the HTML de-encapsulated from RTF message bodies, and
+  # of its plain-text rendering, shared across messages. Forwarded
+  # threads, newsletters and disclaimers repeat the same body over
+  # and over in a mailbox, often as embedded messages, and with a
+  # cache each is decompressed and parsed once.
+  #
+  # Entries are keyed by a hash of the RTF_COMPRESSED property value.
+  # With use_sync_crc=True, messages that have the RTF_SYNC_BODY_CRC
+  # and RTF_SYNC_BODY_COUNT properties are keyed by those (and the
+  # compressed size) instead, which saves hashing the value but
+  # trusts Outlook's 32-bit checksum of the body text to tell bodies
+  # apart.
+  #
+  # At most max_bytes of entries (counted in characters) are kept in
+  # memory, least recently used first out. If directory is given,
+  # entries are also written there as files, and entries not in
+  # memory are looked for there, so that the cache outlives the
+  # process and can be shared by several processes. The files in the
+  # directory are kept to about max_disk_bytes in total by removing
+  # the least recently used, the same way as ConversionCache does.
+  #
+  # A cache can be shared by threads (it is locked while it is
+  # updated) and, when pickled, copied to worker processes.
+
+  COUNTERS = ("hits", "disk_hits", "misses") # see _counters
+
+  def __init__(self, max_bytes=64*1024*1024, directory=None, use_sync_crc=False,
+      max_disk_bytes=1024*1024*1024):
+    self.max_bytes = max_bytes
+    self.directory = directory
+    self.use_sync_crc = use_sync_crc
+    self.max_disk_bytes = max_disk_bytes
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._size = 0
+    self._disk_size = None # running total of the files' sizes, once counted
+    self._lock = threading.Lock()
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+
+  def __getstate__(self):
+    return _without_lock(self)
+
+  def __setstate__(self, state):
+    _set_state_with_lock(self, state)
+
+  def key(self, props, text_backfill=None):
+    # Return the cache key of the RTF body of a message, given its
+    # properties. text_backfill names the way the plain-text body is
+    # made from the HTML (see text_backfill_name), since the text
+    # stored in the entry depends on it.
+    import hashlib
+    rtf_compressed = props['RTF_COMPRESSED']
+    if self.use_sync_crc and 'RTF_SYNC_BODY_CRC' in props and 'RTF_SYNC_BODY_COUNT' in props:
+      key = "crc-{:08x}-{:x}-{:x}".format(props['RTF_SYNC_BODY_CRC'] & 0xffffffff,
+        props['RTF_SYNC_BODY_COUNT'], len(rtf_compressed))
+    else:
+      key = "sha256-" + hashlib.sha256(rtf_compressed).hexdigest()
+    if text_backfill is not None:
+      key += "-" + re.sub(r"[^\w.]", "_", text_backfill)
+    return key
+
+  def get(self, key):
+    # Return the (html_body, text_body) pair stored under key, or None.
+    # text_body is None if it hasn't been computed.
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    if self.directory is not None:
+      entry = self._read(key)
+      if entry is not None:
+        with self._lock:
+          self._store(key, entry)
+          self.hits += 1
+          self.disk_hits += 1
+        return entry
+    with self._lock:
+      self.misses += 1
+    return None
+
+  def put(self, key, html_body, text_body=None):
+    entry = (html_body, text_body)
+    with self._lock:
+      self._store(key, entry)
+    if self.directory is not None:
+      self._write(key, entry)
+
+  def stats(self):
+    # Return a dict of the cache's hit and miss counts, hit rate, and
+    # size in memory.
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "disk_hits": self.disk_hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups else 0.0,
+        "entries": len(self._entries),
+        "bytes": self._size,
+      }
+
+  def _store(self, key, entry):
+    # (Called with the lock held.)
+    size = len(entry[0]) + len(entry[1] or "")
+    old = self._entries.pop(key, None)
+    if old is not None:
+      self._size -= len(old[0]) + len(old[1] or "")
+    if size > self.max_bytes:
+      return
+    self._entries[key] = entry
+    self._size += size
+    while self._size > self.max_bytes:
+      _, old = self._entries.popitem(last=False)
+      self._size -= len(old[0]) + len(old[1] or "")
+
+  def _path(self, key):
+    # Spread the files over subdirectories by the start of the hash.
+    return os.path.join(self.directory, key.split("-")[1][:2], key + ".json")
+
+  def _read(self, key):
+    import json
+    path = self._path(key)
+    try:
+      with open(path, encoding="utf-8") as f:
+        entry = json.load(f)
+      entry = (entry["html"], entry["text"])
+    except (OSError, ValueError, KeyError, TypeError):
+      return None
+    try:
+      os.utime(path) # mark as recently used
+    except OSError:
+      pass
+    return entry
+
+  def _write(self, key, entry):
+    import json
+    path = self._path(key)
+    data = json.dumps({ "html": entry[0], "text": entry[1] }).encode("utf-8")
+    size = len(data)
+    if size > self.max_disk_bytes:
+      return
+    try:
+      with _atomic_write(path) as f:
+        f.write(data)
+    except OSError as e:
+      logger.warning("Could not write RTF cache entry {}: {}".format(path, e))
+      return
+
+    with self._lock:
+      if self._disk_size is None:
+        self._disk_size = _count_cache_files(self.directory, ".json")[0]
+      else:
+        self._disk_size += size
+      if self._disk_size > self.max_disk_bytes:
+        self._disk_size = _evict_cache_files(self.directory, ".json", self.max_disk_bytes)
+
+
+# CONVERSION CACHE
+
+# Bump this when a change to the converter changes its output, so that
+# output cached by an older version isn't used.
+CONVERSION_CACHE_VERSION = 2
+
+
+class ConversionCache(object):
+  # An on-disk cache of converted messages, for when the same .msg
+  # files are converted again and again (re-ingested exports, the
+  # same file under different paths). Entries are keyed by a hash of
+  # the .msg file's content and of the options that affect the output,
+  # and hold the MIME output as a file in directory.
+  #
+  # The files in the cache are kept to about max_bytes in total: when
+  # an entry is added that takes the total over max_bytes, the least
+  # recently used entries are removed until the total is under 90%
+  # of it. The cache directory can be shared by several processes,
+  # each of which keeps its own running total, so the total can
+  # overshoot until one of them next counts the files. Like RtfCache,
+  # it can be shared by threads.
+
+  COUNTERS = ("hits", "misses")
+
+  def __init__(self, directory, max_bytes=1024*1024*1024):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self._size = None # running total of the entries' sizes, once counted
+    self._lock = threading.Lock()
+    os.makedirs(directory, exist_ok=True)
+
+  def __getstate__(self):
+    return _without_lock(self)
+
+  def __setstate__(self, state):
+    _set_state_with_lock(self, state)
+
+  def key(self, filename_or_stream, **options):
+    # Return the key of a .msg file (a filename or a binary file-like
+    # object, which is read to the end and then returned to where it
+    # was) converted with the given options.
+    import hashlib
+    h = hashlib.sha256()
+    h.update("v{}".format(CONVERSION_CACHE_VERSION).encode("ascii"))
+    for name, value in sorted(options.items()):
+      if name == "text_backfill":
+        value = text_backfill_name(value)
+      h.update("\0{}={!r}".format(name, value).encode("utf-8"))
+    h.update(b"\0")
+    if isinstance(filename_or_stream, (str, bytes, os.PathLike)):
+      with open(filename_or_stream, "rb") as f:
+        self._hash_stream(h, f)
+    else:
+      position = filename_or_stream.tell()
+      self._hash_stream(h, filename_or_stream)
+      filename_or_stream.seek(position)
+    return h.hexdigest()
+
+  @staticmethod
+  def _hash_stream(h, f):
+    while True:
+      data = f.read(SPILL_CHUNK_SIZE)
+      if not data:
+        break
+      h.update(data)
+
+  def open(self, key):
+    # Return the cached output for key as a binary file, or None if
+    # it isn't in the cache.
+    path = self._path(key)
+    try:
+      f = open(path, "rb")
+    except OSError:
+      with self._lock:
+        self.misses += 1
+      return None
+    try:
+      os.utime(path) # mark as recently used
+    except OSError:
+      pass
+    with self._lock:
+      self.hits += 1
+    return f
+
+  @contextlib.contextmanager
+  def writer(self, key):
+    # Return a context manager that gives a binary file to write the
+    # output for key to, which is added to the cache when the context
+    # exits without an exception. It gives None if the file can't be
+    # created, so that an unusable cache directory doesn't make
+    # conversions fail.
+    path = self._path(key)
+    with contextlib.ExitStack() as stack:
+      try:
+        f = stack.enter_context(_atomic_write(path))
+      except OSError as e:
+        logger.warning("Could not add to conversion cache {}: {}".format(self.directory, e))
+        yield None
+        return
+      yield f
+      size = f.tell()
+      if size > self.max_bytes:
+        # Don't empty the whole cache for one entry.
+        raise _DiscardWrite()
+    if size > self.max_bytes:
+      return
+
+    with self._lock:
+      if self._size is None:
+        self._size = _count_cache_files(self.directory, ".eml")[0]
+      else:
+        self._size += size
+      if self._size > self.max_bytes:
+        self._size = _evict_cache_files(self.directory, ".eml", self.max_bytes)
+
+  def stats(self):
+    # Return a dict of the cache's hit and miss counts and hit rate.
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups else 0.0,
+      }
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key + ".eml")
+
+
+def _count_cache_files(directory, suffix):
+  # Return the total size of the files ending with suffix in the
+  # subdirectories of a cache directory, and a list of (last used
+  # time, size, path) tuples for them.
+  total = 0
+  entries = []
+  with os.scandir(directory) as subdirs:
+    for subdir in subdirs:
+      if not subdir.is_dir():
+        continue
+      with os.scandir(subdir.path) as files:
+        for entry in files:
+          if not entry.name.endswith(suffix):
+            continue
+          try:
+            stat = entry.stat()
+          except OSError:
+            continue
+          total += stat.st_size
+          entries.append((stat.st_mtime, stat.st_size, entry.path))
+  return total, entries
+
+
+def _evict_cache_files(directory, suffix, max_bytes):
+  # Remove the least recently used files ending with suffix from a
+  # cache directory until their total size is under 90% of
+  # max_bytes, and return the total size left.
+  total, entries = _count_cache_files(directory, suffix)
+  entries.sort()
+  target = max_bytes * 0.9
+  for _, size, path in entries:
+    if total <= target:
+      break
+    try:
+      os.unlink(path)
+    except OSError:
+      continue
+    total -= size
+  return total
+
+
+class _TeeWriter(object):
+  # A binary file-like object that writes to several others.
+
+  def __init__(self, *streams):
+    self.streams = streams
+
+  def write(self, data):
+    for stream in self.streams:
+      stream.write(data)
+    return len(data)
+
+
+# ATTACHMENT STORE
+
+class AttachmentStore(object):
+  # A content-addressed store of attachment content on disk, for batch
+  # conversions where the same files (PDFs, logos, disclaimers) are
+  # attached to thousands of messages. Each distinct attachment is
+  # written once, as directory/ab/abcdef... named by the SHA-256 hash
+  # of its content, and the message gets a message/external-body part
+  # that refers to the file (with access-type=local-file) instead of
+  # the base64-encoded content. The part also has an X-Attachment-Ref
+  # header giving the hash ("sha256:abcdef..."), which stays valid if
+  # the store is moved.
+  #
+  # Attachments smaller than min_size bytes, and attached messages,
+  # are kept in the message as usual. Files in the store are never
+  # removed, and the directory can be shared by several processes.
+  # Like RtfCache, a store can be shared by threads.
+
+  COUNTERS = ("attachments", "stored", "bytes", "bytes_stored")
+
+  def __init__(self, directory, min_size=0):
+    self.directory = os.path.abspath(directory)
+    self.min_size = min_size
+    self.attachments = 0 # attachments referred to the store
+    self.stored = 0 # ... of which were written to it
+    self.bytes = 0
+    self.bytes_stored = 0
+    self._writing = { } # hash -> Event set when another thread has written it
+    self._lock = threading.Lock()
+    os.makedirs(self.directory, exist_ok=True)
+
+  def __getstate__(self):
+    state = _without_lock(self)
+    state["_writing"] = { }
+    return state
+
+  def __setstate__(self, state):
+    _set_state_with_lock(self, state)
+
+  def put(self, opener):
+    # Add the content read from the binary file-like object that
+    # opener returns to the store, unless it is already there, and
+    # return its (hash, size, path). The content is hashed first, so
+    # that a duplicate is only read, not written, and is read again
+    # to be written only if it is new.
+    import hashlib
+    h = hashlib.sha256()
+    size = 0
+    with opener() as stream:
+      while True:
+        data = stream.read(SPILL_CHUNK_SIZE)
+        if not data:
+          break
+        h.update(data)
+        size += len(data)
+    digest = h.hexdigest()
+    path = self._path(digest)
+
+    # If another thread is writing the same content, wait for it
+    # rather than writing it again.
+    with self._lock:
+      self.attachments += 1
+      self.bytes += size
+      written = self._writing.get(digest)
+      new = written is None and not os.path.exists(path)
+      if new:
+        written = self._writing[digest] = threading.Event()
+    if not new:
+      if written is not None:
+        written.wait()
+      return digest, size, path
+
+    try:
+      self._write(opener, path)
+    finally:
+      with self._lock:
+        del self._writing[digest]
+      written.set()
+    with self._lock:
+      self.stored += 1
+      self.bytes_stored += size
+    return digest, size, path
+
+  def stats(self):
+    # Return a dict of the number and total size of the attachments
+    # referred to the store and of those that were new to it, the
+    # bytes saved by not writing duplicates, and the dedup ratio: the
+    # fraction of the attachment bytes that were duplicates.
+    with self._lock:
+      saved = self.bytes - self.bytes_stored
+      return {
+        "attachments": self.attachments,
+        "stored": self.stored,
+        "bytes": self.bytes,
+        "bytes_stored": self.bytes_stored,
+        "bytes_saved": saved,
+        "dedup_ratio": saved / self.bytes if self.bytes else 0.0,
+      }
+
+  def _path(self, digest):
+    return os.path.join(self.directory, digest[:2], digest)
+
+  def _write(self, opener, path):
+    import shutil
+    with _atomic_write(path) as f, opener() as stream:
+      shutil.copyfileobj(stream, f, SPILL_CHUNK_SIZE)
+
+
+def add_stored_attachment(msg, digest, size, path, maintype, subtype, filename):
+  # Add an attachment to msg that refers to content in an
+  # AttachmentStore, as a message/external-body part (RFC 2046) whose
+  # body holds the headers that the attachment would have had.
+  if msg.get_content_type() != "multipart/mixed":
+    msg.make_mixed()
+
+  headers = email.message.EmailMessage(policy=msg.policy)
+  headers["Content-Type"] = "{}/{}".format(maintype, subtype)
+  headers.add_header("Content-Disposition", "attachment", filename=filename)
+  headers["Content-Transfer-Encoding"] = "binary"
+
+  part = email.message.EmailMessage(policy=msg.policy)
+  part["Content-Type"] = "message/external-body"
+  part.set_param("access-type", "local-file")
+  part.set_param("name", path)
+  part.set_param("size", str(size))
+  part["X-Attachment-Ref"] = "sha256:" + digest
+  part.attach(headers)
+  msg.attach(part)
+  return part
+
+
+# RESOURCE BUDGETS
+
+# The compound file directory gives the size of every stream before
+# any of them is read, so the resources a conversion will need can be
+# estimated up front: to send very large messages to workers with more
+# memory, say, or to refuse them.
+
+def estimate_message(filename_or_stream):
+  # Return the pre-flight estimate of estimate_document for a .msg
+  # file. Only the compound file's header and directory are read.
+  with open_document(filename_or_stream) as doc:
+    return estimate_document(doc)
+
+
+def estimate_document(doc):
+  # Return a dict estimating the cost of converting an open document,
+  # from the sizes of its streams:
+  #
+  #   file_size           the size of the .msg file
+  #   stream_bytes        the total size of its streams
+  #   messages            the number of messages, including attached ones
+  #   depth               how deeply attached messages are nested
+  #   attachments         the number of attachments, at all levels
+  #   attachment_bytes    the total size of their content
+  #   largest_attachment  the size of the largest
+  #   output_bytes        roughly how large the MIME message will be
+  #                       (attachments grow by a third in base64)
+  #   memory_bytes        roughly how much memory load() will need to
+  #                       hold both the content and the MIME message
+  estimate = estimate_storage(doc.root)
+  estimate["messages"] += 1
+  estimate["file_size"] = doc._file_size
+  estimate["output_bytes"] = estimate["stream_bytes"] - estimate["attachment_bytes"] \
+    + estimate["attachment_bytes"] * 77 // 57 # 57 bytes per 76-character line
+  estimate["memory_bytes"] = estimate["stream_bytes"] + estimate["output_bytes"]
+  return estimate
+
+
+def estimate_storage(entry, estimate=None, depth=0):
+  # Add up the sizes of the streams in a storage and the storages in
+  # it, and count the attachments and attached messages, in estimate.
+  if estimate is None:
+    estimate = { "stream_bytes": 0, "messages": 0, "depth": 0, "attachments": 0,
+      "attachment_bytes": 0, "largest_attachment": 0 }
+  for child in entry:
+    name = child.name.upper()
+    if child.isfile:
+      estimate["stream_bytes"] += child.size
+      if name == "__SUBSTG1.0_37010102":
+        estimate["attachment_bytes"] += child.size
+        estimate["largest_attachment"] = max(estimate["largest_attachment"], child.size)
+    elif name == "__SUBSTG1.0_3701000D":
+      estimate["messages"] += 1
+      estimate["depth"] = max(estimate["depth"], depth + 1)
+      estimate_storage(child, estimate, depth + 1)
+    else:
+      if name.startswith("__ATTACH_VERSION1.0_#"):
+        estimate["attachments"] += 1
+      estimate_storage(child, estimate, depth)
+  return estimate
+
+
+class BudgetExceeded(Exception):
+  # Raised when a message is over its ResourceBudget. estimate is the
+  # message's estimate_document.
+  def __init__(self, message, estimate=None):
+    super().__init__(message)
+    self.estimate = estimate
+
+
+class ResourceBudget(object):
+  # Limits on converting a message: on the total size of its streams
+  # (max_bytes), on its number of attachments at all levels
+  # (max_attachments), and on the time taken (max_seconds).
+  #
+  # The size and attachment limits are checked against the message's
+  # estimate_document before anything is read. A message over them
+  # is rejected with BudgetExceeded or, if degrade is True, converted
+  # with attachments left out: the top-level attachments (with
+  # everything in them) are taken in order while they fit in the
+  # limits, and each one that doesn't is replaced by a short text
+  # attachment saying so. When max_seconds runs out, the conversion
+  # is stopped with BudgetExceeded or, if degrade is True, the
+  # remaining attachments are left out the same way.
+
+  def __init__(self, max_bytes=None, max_attachments=None, max_seconds=None, degrade=False):
+    self.max_bytes = max_bytes
+    self.max_attachments = max_attachments
+    self.max_seconds = max_seconds
+    self.degrade = degrade
+
+  def exceeded(self, estimate):
+    # Return a list describing the limits that an estimate_document
+    # is over, which is empty if it is within them.
+    over = []
+    if self.max_bytes is not None and estimate["stream_bytes"] > self.max_bytes:
+      over.append("{} bytes (limit {})".format(estimate["stream_bytes"], self.max_bytes))
+    if self.max_attachments is not None and estimate["attachments"] > self.max_attachments:
+      over.append("{} attachments (limit {})".format(estimate["attachments"],
+        self.max_attachments))
+    return over
+
+
+def start_budget(doc, budget, started=None):
+  # Check an open document against budget, raising BudgetExceeded if
+  # it is over and the budget doesn't degrade, and set up the state
+  # that within_budget keeps.
+  doc.deadline = None
+  if budget.max_seconds is not None:
+    doc.deadline = (started or time.perf_counter()) + budget.max_seconds
+  doc.estimate = estimate_document(doc)
+  over = budget.exceeded(doc.estimate)
+  if over and not budget.degrade:
+    raise BudgetExceeded("message is over its budget: " + ", ".join(over), doc.estimate)
+
+  # Start with what the message takes up without its top-level
+  # attachments, to which those that fit are added.
+  doc.over_budget = bool(over)
+  doc.budget_used = { "stream_bytes": doc.estimate["stream_bytes"], "attachments": 0 }
+  if over:
+    for child in doc.root:
+      if child.isdir and child.name.startswith("__attach_version1.0_#"):
+        doc.budget_used["stream_bytes"] -= estimate_storage(child)["stream_bytes"]
+
+
+def within_budget(doc, entry):
+  # Return whether the attachment in entry is to be converted, or
+  # False if it is to be left out to keep within the document's
+  # budget. Raises BudgetExceeded if time has run out and the budget
+  # doesn't degrade.
+  budget = doc.budget
+  if doc.deadline is not None and time.perf_counter() > doc.deadline:
+    if not budget.degrade:
+      raise BudgetExceeded("conversion took over {} seconds".format(budget.max_seconds),
+        doc.estimate)
+    return False
+  if not doc.over_budget or doc.message_depth > 0:
+    return True
+  estimate = estimate_storage(entry)
+  stream_bytes = doc.budget_used["stream_bytes"] + estimate["stream_bytes"]
+  attachments = doc.budget_used["attachments"] + 1 + estimate["attachments"]
+  if (budget.max_bytes is not None and stream_bytes > budget.max_bytes) or \
+      (budget.max_attachments is not None and attachments > budget.max_attachments):
+    return False
+  doc.budget_used["stream_bytes"] = stream_bytes
+  doc.budget_used["attachments"] = attachments
+  return True
+
+
+# INSTRUMENTATION
+
+# When an instrument function is given to load(), convert() or
+# open_document(), it is called as
+#
+#   instrument(stage, message, seconds, nbytes)
+#
+# after each stage of the conversion, where stage is one of
+#
+#   "open"             opening the .msg file (nbytes: the file size)
+#   "properties"       parsing a message's properties stream
+#                      (nbytes: the stream size)
+#   "rtf_decompress"   decompressing RTF_COMPRESSED (nbytes: RTF size)
+#   "rtf_decapsulate"  extracting HTML from the RTF (nbytes: HTML length)
+#   "text_backfill"    making a plain-text body from the HTML
+#                      (nbytes: text length)
+#   "attachment"       adding an attachment (nbytes: ATTACH_DATA_BIN size)
+#   "message"          loading a whole message, including its attachments
+#                      but not the messages attached to it, which are
+#                      loaded (and reported) later: in convert(), while
+#                      the message is written
+#   "serialize"        writing the MIME message, in convert() only
+#
+# and message identifies the message that the stage belongs to: "" for
+# the top-level message, and for an embedded message the path of
+# attachment numbers leading to it, e.g. "/0" or "/0/2". nbytes is None
+# where not applicable. Without an instrument nothing is timed.
+
+
+def report_stage(doc, stage, started, nbytes=None):
+  # Report a stage that started at time.perf_counter() value started
+  # to the instrument, and return the time it ended.
+  ended = time.perf_counter()
+  doc.instrument(stage, doc.message_path, ended - started, nbytes)
+  return ended
+
+
+def instrumented_process_attachment(msg, entry, doc):
+  # process_attachment with the "attachment" stage reported, and with
+  # the message path of an embedded message loaded from it set.
+  started = time.perf_counter()
+  path = doc.message_path
+  doc.message_path = "{}/{}".format(path, int(entry.name.rsplit("#", 1)[-1], 16))
+  try:
+    process_attachment(msg, entry, doc)
+  finally:
+    doc.message_path = path
+  nbytes = None
+  for stream in entry:
+    if stream.name.upper() == "__SUBSTG1.0_37010102":
+      nbytes = stream.size
+  report_stage(doc, "attachment", started, nbytes)
+
+
+class StageTimings(object):
+  # An instrument that keeps what it is called with as a list of
+  # (stage, message, seconds, nbytes) tuples in records, and can sum
+  # them up by stage.
+
+  def __init__(self):
+    self.records = []
+
+  def __call__(self, stage, message, seconds, nbytes):
+    self.records.append((stage, message, seconds, nbytes))
+
+  def totals(self):
+    # Return a dict mapping each stage to a dict of the number of
+    # times it ran and the total seconds and bytes.
+    totals = { }
+    for stage, message, seconds, nbytes in self.records:
+      total = totals.setdefault(stage, { "count": 0, "seconds": 0.0, "bytes": 0 })
+      total["count"] += 1
+      total["seconds"] += seconds
+      total["bytes"] += nbytes or 0
+    return totals
+
+
+# STREAM ACCESS
+
+SPILL_CHUNK_SIZE = 1024 * 1024
+
+def map_document(doc):
+  # Memory-map the file underlying an open document for zero-copy
+  # reads, or return None if it isn't a real file. This is a separate
+  # mapping from the one compoundfiles makes (and closes) so that
+  # memoryviews of it can outlive the document: the mapping is
+  # released when the last view is. The views are found from the
+  # internals of compoundfiles' documents and streams (see
+  # _mapped_view), so without them the file isn't mapped at all.
+  if not all(hasattr(doc, name) for name in COMPOUNDFILES_DOCUMENT_INTERNALS):
+    return None
+  try:
+    return mmap.mmap(doc._file.fileno(), 0, access=mmap.ACCESS_READ)
+  except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+    return None
+
 
-  return properties
+def read_stream(doc, entity):
+  # Return the content of a stream in the document, either as bytes
+  # or, in zero-copy mode, as a memoryview of the mapped file if the
+  # stream occupies contiguous sectors. Small streams are stored in
+  # the mini stream and are always copied.
+  with doc.open(entity) as stream:
+    view = _mapped_view(doc, stream)
+    if view is not None:
+      return view
+    return stream.read()
+
+
+def open_stream(doc, entity):
+  # Return a binary file-like object for reading a stream in the
+  # document, reading from the mapped file if possible (see
+  # read_stream).
+  stream = doc.open(entity)
+  view = _mapped_view(doc, stream)
+  if view is None:
+    return stream
+  stream.close()
+  return io.BufferedReader(_MemoryViewStream(view))
+
+
+def spill_stream(doc, entity):
+  # Move the content of a stream in the document out of memory so
+  # that it remains available after the document is closed, and
+  # return a function that opens it for reading (for AttachmentPart).
+  with doc.open(entity) as stream:
+    view = _mapped_view(doc, stream)
+  if view is not None:
+    # The view keeps the mapped file open for as long as it is used.
+    return lambda: io.BufferedReader(_MemoryViewStream(view))
+
+  import shutil, tempfile
+  f = tempfile.TemporaryFile()
+  with open_stream(doc, entity) as stream:
+    shutil.copyfileobj(stream, f, SPILL_CHUNK_SIZE)
+  f.flush()
+
+  # The temporary file is deleted when the last reference to this
+  # function (i.e. the message part) is gone.
+  def opener():
+    stream = open(os.dup(f.fileno()), "rb")
+    stream.seek(0)
+    return stream
+  return opener
+
+
+# The private attributes of compoundfiles' documents and streams that
+# zero-copy reads rely on (as of compoundfiles 0.3). If a version of
+# compoundfiles doesn't have them, streams are read the normal way.
+COMPOUNDFILES_DOCUMENT_INTERNALS = ("_file", "_normal_sector_size", "_header_size")
+COMPOUNDFILES_STREAM_INTERNALS = ("_sectors", "_length")
+
+def _mapped_view(doc, stream):
+  from compoundfiles.streams import CompoundFileNormalStream
+  if doc.mapped is None or not isinstance(stream, CompoundFileNormalStream) \
+      or not all(hasattr(stream, name) for name in COMPOUNDFILES_STREAM_INTERNALS):
+    return None
+
+  # Check that the sectors holding the stream are contiguous.
+  sector_size = doc._normal_sector_size
+  count = (stream._length + sector_size - 1) // sector_size
+  sectors = list(stream._sectors[:count])
+  if not sectors or sectors != list(range(sectors[0], sectors[0] + count)):
+    return None
+
+  offset = doc._header_size + sectors[0] * sector_size
+  if offset + stream._length > len(doc.mapped):
+    return None
+  return memoryview(doc.mapped)[offset:offset + stream._length]
+
+
+class _MemoryViewStream(io.RawIOBase):
+  # A readable raw stream over a memoryview.
+  def __init__(self, view):
+    self._view = view
+    self._pos = 0
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    n = min(len(b), len(self._view) - self._pos)
+    b[:n] = self._view[self._pos:self._pos + n]
+    self._pos += n
+    return n
+
+
+# STREAMING OUTPUT
+
+class AttachmentPart(email.message.EmailMessage):
+  # A MIME part holding base64-encoded content that is read from
+  # a stream only when it is needed. opener is a function that
+  # returns a new binary file-like object positioned at the start
+  # of the unencoded content. write_message encodes the content in
+  # chunks straight to its output. Anything else that looks at the
+  # payload (as_bytes(), get_content(), ...) gets it encoded all
+  # at once, so the part otherwise behaves like any other.
+
+  _opener = None
+
+  @property
+  def _payload(self):
+    if self._opener is None:
+      return self._inline_payload
+    buf = io.BytesIO()
+    with self._opener() as stream:
+      write_base64(stream, buf, self.policy)
+    return buf.getvalue().decode("ascii")
+
+  @_payload.setter
+  def _payload(self, value):
+    # Setting the payload directly (e.g. set_content) replaces
+    # the streamed content.
+    self._opener = None
+    self._inline_payload = value
+
+
+def add_streamed_attachment(msg, opener, maintype, subtype, filename):
+  # Add an attachment to msg like msg.add_attachment(blob, ...)
+  # but with content that is read through opener when the message
+  # is written (see AttachmentPart).
+  if msg.get_content_type() != "multipart/mixed":
+    msg.make_mixed()
+
+  # Let set_content create the same headers that add_attachment
+  # would, then swap in the streamed content.
+  part = AttachmentPart(policy=msg.policy)
+  part.set_content(b"", maintype=maintype, subtype=subtype, filename=filename)
+  part._opener = opener
+  msg.attach(part)
+  return part
+
+
+def write_base64(src, dst, policy):
+  # Read src to its end and write its content base64-encoded to
+  # dst in lines no longer than the policy's maximum line length,
+  # the same way that EmailMessage.set_content encodes bytes.
+  line_size = (policy.max_line_length or 78) // 4 * 3
+  chunk_size = line_size * 1024
+  linesep = policy.linesep.encode("ascii")
+  pending = b""
+  while True:
+    chunk = src.read(chunk_size)
+    if not chunk:
+      break
+    chunk = pending + chunk
+    whole = len(chunk) - len(chunk) % line_size
+    pending = chunk[whole:]
+    _write_base64_lines(chunk[:whole], dst, line_size, linesep)
+  _write_base64_lines(pending, dst, line_size, linesep)
+
+
+def _write_base64_lines(data, dst, line_size, linesep):
+  if line_size == 57 and linesep == b"\n":
+    # The usual case, which the base64 module can do all at once.
+    dst.write(base64.encodebytes(data))
+    return
+  for i in range(0, len(data), line_size):
+    line = base64.b64encode(data[i:i+line_size])
+    dst.write(line + linesep)
+
+
+def write_message(msg, fp, policy=None):
+  # Write msg to the binary file-like object fp, producing the same
+  # bytes as msg.as_bytes() would. Unlike as_bytes(), each part is
+  # written out as soon as it is rendered instead of the whole
+  # message being collected in memory first, and the content of
+  # AttachmentParts is encoded directly to fp in chunks.
+  if policy is None:
+    policy = msg.policy
+  nl = policy.linesep.encode("ascii")
+
+  def write_headers(part):
+    for header, value in part.raw_items():
+      fp.write(policy.fold_binary(header, value))
+    fp.write(nl)
+
+  if msg.get_content_maintype() == "multipart" and isinstance(msg._payload, list):
+    boundary = msg.get_boundary()
+    if not boundary:
+      # Like the email generator, but without being able to check
+      # the boundary against the text of parts not yet written.
+      boundary = email.generator.Generator._make_boundary()
+      msg.set_boundary(boundary)
+    boundary = boundary.encode("ascii")
+    write_headers(msg)
+    if msg.preamble is not None:
+      fp.write(msg.preamble.encode("ascii", "surrogateescape") + nl)
+    for i, part in enumerate(msg._payload):
+      fp.write((nl if i > 0 else b"") + b"--" + boundary + nl)
+      write_message(part, fp, policy)
+    fp.write(nl + b"--" + boundary + b"--" + nl)
+    if msg.epilogue is not None:
+      fp.write(msg.epilogue.encode("ascii", "surrogateescape"))
+
+  elif isinstance(msg, EmbeddedMessagePart) and msg._loader is not None:
+    # An attached message not yet converted. It is converted now and
+    # dropped once it has been written.
+    write_headers(msg)
+    write_message(msg._loader(), fp, policy)
+
+  elif msg.get_content_maintype() == "message" and isinstance(msg._payload, list):
+    # An attached message.
+    write_headers(msg)
+    write_message(msg._payload[0], fp, policy)
+
+  elif isinstance(msg, AttachmentPart) and msg._opener is not None:
+    write_headers(msg)
+    with msg._opener() as stream:
+      write_base64(stream, fp, policy)
+
+  else:
+    email.generator.BytesGenerator(fp, mangle_from_=False, policy=policy)\
+      .flatten(msg)
+
+
+# EMBEDDED MESSAGES
+
+class EmbeddedMessagePart(email.message.EmailMessage):
+  # A message/rfc822 part holding an attached message that is only
+  # converted when it is needed. loader is a function that converts
+  # the message and returns it. write_message converts it as it is
+  # written and then lets it go, so that when a message is converted
+  # with convert() only one attached message at each level of nesting
+  # is in memory at a time. Anything else that looks at the payload
+  # converts it and keeps it.
+
+  _loader = None
+
+  @property
+  def _payload(self):
+    if self._loader is not None:
+      self._inline_payload = [self._loader()]
+      self._loader = None
+    return self._inline_payload
+
+  @_payload.setter
+  def _payload(self, value):
+    self._loader = None
+    self._inline_payload = value
+
+
+def add_embedded_message(msg, entry, doc, filename):
+  # Add the message in the storage entry to msg as an attachment,
+  # either as an EmbeddedMessagePart or, if it is over the document's
+  # depth or size limits (see open_document), as a .msg file.
+  depth = doc.message_depth + 1
+  size = message_size(entry)
+  if (doc.max_depth is not None and depth > doc.max_depth) or \
+      (doc.max_embedded_bytes is not None and doc.embedded_bytes + size > doc.max_embedded_bytes):
+    if not filename.lower().endswith(".msg"):
+      filename += ".msg"
+    if doc.stream_attachments:
+      add_streamed_attachment(msg, lambda: io.BytesIO(embedded_message_file(doc, entry)),
+        maintype="application", subtype="vnd.ms-outlook", filename=filename)
+    else:
+      msg.add_attachment(embedded_message_file(doc, entry),
+        maintype="application", subtype="vnd.ms-outlook", filename=filename)
+    return
+  doc.embedded_bytes += size
+
+  # The message is converted with the depth and the message path (for
+  # instrumentation) it has here.
+  path = doc.message_path
+  def loader():
+    outer = doc.message_depth, doc.message_path
+    doc.message_depth, doc.message_path = depth, path
+    try:
+      return load_message_stream(entry, False, doc)
+    except BudgetExceeded:
+      raise
+    except Exception as e:
+      # The part's headers may already have been written.
+      logger.error("Error processing attached message: {}".format(str(e)))
+      placeholder = email.message.EmailMessage(policy=MESSAGE_POLICY)
+      placeholder.set_content("<attached message could not be converted>",
+        cte='quoted-printable')
+      return placeholder
+    finally:
+      doc.message_depth, doc.message_path = outer
+
+  if msg.get_content_type() != "multipart/mixed":
+    msg.make_mixed()
+  part = EmbeddedMessagePart(policy=msg.policy)
+  part.set_content(email.message.EmailMessage(policy=msg.policy), filename=filename)
+  part._loader = loader
+  msg.attach(part)
+  return part
+
+
+def load_embedded_messages(msg):
+  # Convert the messages attached to msg, and those attached to them,
+  # that haven't been converted yet, in the order in which
+  # write_message would convert them. Only multipart containers and
+  # attached messages are looked into: looking at the payload of an
+  # AttachmentPart would read and encode its content.
+  if isinstance(msg, AttachmentPart):
+    return
+  if isinstance(msg, EmbeddedMessagePart) or msg.get_content_maintype() in ("multipart", "message"):
+    payload = msg._payload
+    if isinstance(payload, list):
+      for part in payload:
+        load_embedded_messages(part)
+
+
+def message_size(entry):
+  # Return the total size of the streams of the message in a storage,
+  # including its attachments but not the messages attached to it
+  # (which are counted when they are converted), without reading them.
+  size = 0
+  for child in entry:
+    if child.isfile:
+      size += child.size
+    elif child.name.upper() != "__SUBSTG1.0_3701000D":
+      size += message_size(child)
+  return size
+
+
+def embedded_message_file(doc, entry):
+  # Return the message in the storage entry as the bytes of a .msg
+  # file of its own. An embedded message is stored like a top-level
+  # message, except that its properties stream has a shorter header
+  # ([MS-OXMSG] 2.4.1) and the named property mapping is kept only at
+  # the top level of the document, so it is copied from there.
+  tree = _storage_tree(doc, entry)
+  for name, value in tree.items():
+    if name.lower() == "__properties_version1.0" and isinstance(value, bytes):
+      tree[name] = value[:EMBEDDED_MESSAGE_HEADER_SIZE] \
+        + bytes(TOP_LEVEL_HEADER_SIZE - EMBEDDED_MESSAGE_HEADER_SIZE) \
+        + value[EMBEDDED_MESSAGE_HEADER_SIZE:]
+  if not any(name.lower() == "__nameid_version1.0" for name in tree):
+    for child in doc.root:
+      if child.isdir and child.name.lower() == "__nameid_version1.0":
+        tree[child.name] = _storage_tree(doc, child)
+  return write_compound_file(tree)
+
+
+def _storage_tree(doc, entry):
+  # Read a storage into a dict of names to stream content (bytes) and
+  # storages (dicts), for write_compound_file.
+  return { child.name: _storage_tree(doc, child) if child.isdir else bytes(read_stream(doc, child))
+    for child in entry }
+
+
+# COMPOUND FILE WRITER
+
+# A minimal writer for the Compound File Binary format (version 3,
+# 512-byte sectors), used to write an embedded message out as a .msg
+# file of its own (see embedded_message_file).
+
+CFB_SECTOR_SIZE = 512
+CFB_MINI_SECTOR_SIZE = 64
+CFB_MINI_STREAM_CUTOFF = 4096
+
+CFB_FREESECT = 0xFFFFFFFF
+CFB_ENDOFCHAIN = 0xFFFFFFFE
+CFB_FATSECT = 0xFFFFFFFD
+CFB_DIFSECT = 0xFFFFFFFC
+CFB_NOSTREAM = 0xFFFFFFFF
+
+CFB_STORAGE = 1
+CFB_STREAM = 2
+CFB_ROOT = 5
+
+
+class _CfbEntry(object):
+  def __init__(self, name, entry_type, data=None):
+    self.name = name
+    self.entry_type = entry_type
+    self.data = data
+    self.children = []
+    self.left = self.right = self.child = CFB_NOSTREAM
+    self.start = 0
+    self.size = 0 if data is None else len(data)
+
+
+def _cfb_sort_key(entry):
+  # Directory entries are ordered by name length first and then by
+  # the upper-cased name.
+  return (len(entry.name), entry.name.upper())
+
+
+def _cfb_flatten(tree, name, entry_type, entries):
+  entry = _CfbEntry(name, entry_type)
+  entries.append(entry)
+  for child_name, child in sorted(tree.items()):
+    if isinstance(child, dict):
+      entry.children.append(_cfb_flatten(child, child_name, CFB_STORAGE, entries))
+    else:
+      child_entry = _CfbEntry(child_name, CFB_STREAM, bytes(child))
+      entries.append(child_entry)
+      entry.children.append(child_entry)
+  return entry
+
+
+def _cfb_link_children(entry, index_of):
+  # Lay out each storage's children as a balanced binary tree so that
+  # readers which walk siblings recursively do not run out of stack.
+  def build(children):
+    if not children:
+      return CFB_NOSTREAM
+    mid = len(children) // 2
+    node = children[mid]
+    node.left = build(children[:mid])
+    node.right = build(children[mid + 1:])
+    return index_of[id(node)]
+
+  entry.child = build(sorted(entry.children, key=_cfb_sort_key))
+  for child in entry.children:
+    if child.entry_type == CFB_STORAGE:
+      _cfb_link_children(child, index_of)
+
+
+def _cfb_chain(fat, start, count):
+  for i in range(count):
+    fat[start + i] = start + i + 1 if i < count - 1 else CFB_ENDOFCHAIN
+
+
+def write_compound_file(tree):
+  # Serialize a tree of storages (dicts) and streams (bytes) keyed by
+  # name into the bytes of a compound file.
+  entries = []
+  root = _cfb_flatten(tree, "Root Entry", CFB_ROOT, entries)
+  index_of = { id(e): i for i, e in enumerate(entries) }
+  _cfb_link_children(root, index_of)
+
+  # Small streams go into the mini stream, large ones into regular sectors.
+  mini_stream = bytearray()
+  mini_fat = []
+  large = []
+  for entry in entries:
+    if entry.entry_type != CFB_STREAM:
+      continue
+    if entry.size < CFB_MINI_STREAM_CUTOFF:
+      if entry.size == 0:
+        entry.start = CFB_ENDOFCHAIN
+        continue
+      count = (entry.size + CFB_MINI_SECTOR_SIZE - 1) // CFB_MINI_SECTOR_SIZE
+      entry.start = len(mini_fat)
+      mini_fat.extend([0] * count)
+      _cfb_chain(mini_fat, entry.start, count)
+      mini_stream += entry.data
+      mini_stream += b"\0" * (count * CFB_MINI_SECTOR_SIZE - entry.size)
+    else:
+      large.append(entry)
+
+  def sectors_for(n):
+    return (n + CFB_SECTOR_SIZE - 1) // CFB_SECTOR_SIZE
+
+  dir_sectors = sectors_for(len(entries) * 128)
+  minifat_sectors = sectors_for(len(mini_fat) * 4)
+  ministream_sectors = sectors_for(len(mini_stream))
+  data_sectors = sum(sectors_for(e.size) for e in large) + ministream_sectors
+  content_sectors = dir_sectors + minifat_sectors + data_sectors
+
+  # The FAT must also describe its own sectors and the DIFAT sectors
+  # that list FAT sectors beyond the 109 that fit in the header.
+  per_sector = CFB_SECTOR_SIZE // 4
+  fat_sectors = 1
+  while True:
+    difat_sectors = max(0, fat_sectors - 109 + per_sector - 2) // (per_sector - 1)
+    if fat_sectors * per_sector >= content_sectors + fat_sectors + difat_sectors:
+      break
+    fat_sectors += 1
+
+  total_sectors = fat_sectors + difat_sectors + content_sectors
+  fat = [CFB_FREESECT] * (fat_sectors * per_sector)
+  for i in range(fat_sectors):
+    fat[i] = CFB_FATSECT
+  for i in range(difat_sectors):
+    fat[fat_sectors + i] = CFB_DIFSECT
+
+  next_sector = fat_sectors + difat_sectors
+  def allocate(count):
+    nonlocal next_sector
+    if count == 0:
+      return CFB_ENDOFCHAIN
+    start = next_sector
+    _cfb_chain(fat, start, count)
+    next_sector += count
+    return start
+
+  dir_start = allocate(dir_sectors)
+  minifat_start = allocate(minifat_sectors)
+  ministream_start = allocate(ministream_sectors)
+  root.start = ministream_start
+  root.size = len(mini_stream)
+  for entry in large:
+    entry.start = allocate(sectors_for(entry.size))
+  assert next_sector == total_sectors
+
+  def padded(data):
+    return bytes(data) + b"\0" * (sectors_for(len(data)) * CFB_SECTOR_SIZE - len(data))
+
+  directory = bytearray()
+  for entry in entries:
+    name = entry.name.encode("utf-16le") + b"\0\0"
+    directory += struct.pack(
+      "<64sHBBLLL16sLQQLLL",
+      name, len(name), entry.entry_type, 1,
+      entry.left, entry.right,
+      entry.child if entry.entry_type != CFB_STREAM else CFB_NOSTREAM,
+      b"\0" * 16, 0, 0, 0,
+      entry.start if entry.entry_type != CFB_STORAGE else 0,
+      entry.size if entry.entry_type != CFB_STORAGE else 0, 0)
+  while len(directory) % CFB_SECTOR_SIZE:
+    directory += struct.pack("<64sHBBLLL16sLQQLLL",
+      b"", 0, 0, 0, CFB_NOSTREAM, CFB_NOSTREAM, CFB_NOSTREAM, b"\0" * 16, 0, 0, 0, 0, 0, 0)
+
+  mini_fat_bytes = struct.pack("<%dL" % len(mini_fat), *mini_fat)
+  mini_fat_bytes += b"\xff" * (minifat_sectors * CFB_SECTOR_SIZE - len(mini_fat_bytes))
+
+  difat = list(range(fat_sectors)) + [CFB_FREESECT] * max(0, 109 - fat_sectors)
+  difat_chain = bytearray()
+  rest = difat[109:]
+  for i in range(difat_sectors):
+    entries = rest[i * (per_sector - 1):(i + 1) * (per_sector - 1)]
+    entries += [CFB_FREESECT] * (per_sector - 1 - len(entries))
+    following = fat_sectors + i + 1 if i < difat_sectors - 1 else CFB_ENDOFCHAIN
+    difat_chain += struct.pack("<%dL" % per_sector, *(entries + [following]))
+  header = struct.pack(
+    "<8s16sHHHHH6sLLLLLLLLL",
+    b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1", b"\0" * 16,
+    0x3E, 3, 0xFFFE, 9, 6, b"\0" * 6,
+    0, fat_sectors, dir_start, 0, CFB_MINI_STREAM_CUTOFF,
+    minifat_start if minifat_sectors else CFB_ENDOFCHAIN, minifat_sectors,
+    fat_sectors if difat_sectors else CFB_ENDOFCHAIN, difat_sectors)
+  header += struct.pack("<109L", *difat[:109])
+
+  out = [header, struct.pack("<%dL" % len(fat), *fat), bytes(difat_chain),
+         bytes(directory), mini_fat_bytes,
+         padded(mini_stream)]
+  for entry in large:
+    out.append(padded(entry.data))
+  return b"".join(out)
 
 
 # PROPERTY VALUE LOADERS
 
+# A property entry in a properties stream.
+PROPERTY_ENTRY = struct.Struct("<HHL8s")
+
+# Little-endian unsigned integers at the start of a fixed-length value.
+UINT16 = struct.Struct("<H")
+UINT32 = struct.Struct("<L")
+UINT64 = struct.Struct("<Q")
+
 class FixedLengthValueLoader(object):
   pass
 
@@ -344,29 +2552,30 @@ class INTEGER16(FixedLengthValueLoader):
   @staticmethod
   def load(value):
     # value is an eight-byte long bytestring holding a two-byte integer.
-    return reduce(lambda a, b : (a<<8)+b, reversed(value[0:2]))
+    return UINT16.unpack_from(value)[0]
 
 class INTEGER32(FixedLengthValueLoader):
   @staticmethod
   def load(value):
     # value is an eight-byte long bytestring holding a four-byte integer.
-    return reduce(lambda a, b : (a<<8)+b, reversed(value[0:4]))
+    return UINT32.unpack_from(value)[0]
 
 class INTEGER64(FixedLengthValueLoader):
   @staticmethod
   def load(value):
     # value is an eight-byte long bytestring holding an eight-byte integer.
-    return reduce(lambda a, b : (a<<8)+b, reversed(value))
+    return UINT64.unpack_from(value)[0]
 
 class INTTIME(FixedLengthValueLoader):
+  EPOCH = datetime(1601, 1, 1)
+
   @staticmethod
   def load(value):
     # value is an eight-byte long bytestring encoding the integer number of
     # 100-nanosecond intervals since January 1, 1601.
-    from datetime import datetime, timedelta
-    value = reduce(lambda a, b : (a<<8)+b, reversed(value)) # bytestring to integer
+    value = UINT64.unpack_from(value)[0] # bytestring to integer
     try:
-        value = datetime(1601, 1, 1) + timedelta(seconds=value/10000000)
+        value = INTTIME.EPOCH + timedelta(seconds=value/10000000)
     except OverflowError:
         value = None
 
@@ -392,17 +2601,17 @@ class STRING8(VariableLengthValueLoader):
     # character replacement so that this never fails.
     for encoding in encodings:
       try:
-        return value.decode(encoding=encoding, errors='strict')
+        return str(value, encoding=encoding, errors='strict')
       except:
         # Try the next one.
         pass
-    return value.decode(encoding=FALLBACK_ENCODING, errors='replace')
+    return str(value, encoding=FALLBACK_ENCODING, errors='replace')
 
 class UNICODE(VariableLengthValueLoader):
   @staticmethod
   def load(value, **kwargs):
     # value is a bytestring encoded in UTF-16.
-    return value.decode("utf16")
+    return str(value, "utf16")
 
 # TODO: The other variable-length tag types are "CLSID", "OBJECT".
 
@@ -929,21 +3138,785 @@ code_pages = {
   65001: "utf-8",
 }
 
+# BATCH CONVERSION
+
+
+def convert_file(filename, output_filename, **options):
+  # Convert one .msg file to a .eml file and return an error string,
+  # or None if the conversion succeeded. options are passed on to
+  # convert(). Exceptions are caught and returned rather than raised
+  # so that one bad file does not stop a batch, and so that the error
+  # can be sent back from a worker process.
+  #
+  # The output is written with _atomic_write, so it is only seen under
+  # output_filename once it is complete. Missing directories in
+  # output_filename are created.
+  try:
+    with _atomic_write(output_filename) as f:
+      convert(filename, f, **options)
+    return None
+  except Exception as e:
+    return "{}: {}".format(type(e).__name__, e)
+
+
+def find_msg_files(directory):
+  # Yield the paths of the .msg files in directory and its
+  # subdirectories. The tree is walked lazily with os.scandir, so
+  # memory use doesn't grow with the number of files. Symbolic links
+  # to directories aren't followed. Directories that can't be read
+  # are logged and skipped.
+  directories = [directory]
+  while directories:
+    path = directories.pop()
+    try:
+      with os.scandir(path) as entries:
+        for entry in entries:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              directories.append(entry.path)
+            elif entry.name.lower().endswith(".msg") and entry.is_file():
+              yield entry.path
+          except OSError as e:
+            logger.error("Could not read {}: {}".format(entry.path, e))
+    except OSError as e:
+      logger.error("Could not read directory {}: {}".format(path, e))
+
+
+# Options that keep state across conversions (the caches and the
+# attachment store's counts), for a worker process. They are given to
+# each worker once, when it starts, so that the state lasts for all of
+# the files the worker converts: the options sent with each task are
+# a fresh copy every time.
+WORKER_OPTIONS = ("rtf_cache", "cache", "attachment_store")
+_worker_options = { }
+
+
+def _init_worker(worker_options):
+  _worker_options.update(worker_options)
+
+
+def _convert_file_task(options, task):
+  filename, output_filename = task
+  if _worker_options:
+    options = dict(options, **_worker_options)
+  return (filename, convert_file(filename, output_filename, **options))
+
+
+def _load_file_task(options, filename):
+  # Like convert_file, but return (filename, message, error).
+  if _worker_options:
+    options = dict(options, **_worker_options)
+  try:
+    return (filename, load(filename, **options), None)
+  except Exception as e:
+    return (filename, None, "{}: {}".format(type(e).__name__, e))
+
+
+def _extract_file_task(options, filename):
+  # Like _load_file_task, but with extract_properties().
+  try:
+    return (filename, extract_properties(filename, **options), None)
+  except Exception as e:
+    return (filename, None, "{}: {}".format(type(e).__name__, e))
+
+
+def convert_files(tasks, jobs=1, max_pending=None, **options):
+  # Convert .msg files given as (filename, output_filename) pairs
+  # and yield (filename, error) tuples in the order the files were
+  # given, where error is as returned by convert_file. options are
+  # passed on to convert(). When jobs is
+  # greater than one, the conversions run in a pool of that many
+  # worker processes. Results are still yielded in input order so
+  # that output is deterministic regardless of which worker finishes
+  # first.
+  #
+  # tasks may be a generator over any number of files: at most
+  # max_pending tasks (by default, four per worker) are taken from it
+  # ahead of the results yielded, so memory use doesn't grow with the
+  # number of files.
+  #
+  # Each worker process gets its own copy of an rtf_cache, cache or
+  # attachment_store in options. Copies share only the directory, so
+  # the counts in an attachment_store's stats() are only kept when
+  # jobs is one.
+  yield from _run_tasks(_convert_file_task, tasks, jobs, max_pending, options)
+
+
+def load_files(filenames, jobs=1, max_pending=None, **options):
+  # Like convert_files(), but load .msg files with load() and yield
+  # (filename, message, error) tuples, where message is None if the
+  # file failed to load, for writing to a mailbox (see write_mbox
+  # and write_maildir). With several jobs, each message is pickled
+  # to be sent back from its worker process, so spill_threshold
+  # can't be used: the spilled attachments are read through
+  # functions, which can't be pickled.
+  if jobs > 1 and options.get("spill_threshold") is not None:
+    raise ValueError("load_files() can't use spill_threshold with more than one job")
+  return _run_tasks(_load_file_task, filenames, jobs, max_pending, options)
+
+
+def extract_files(filenames, jobs=1, max_pending=None, **options):
+  # Like load_files(), but with extract_properties(), yielding
+  # (filename, properties, error) tuples.
+  yield from _run_tasks(_extract_file_task, filenames, jobs, max_pending, options)
+
+
+def _run_tasks(task_fn, tasks, jobs, max_pending, options):
+  # Yield task_fn(options, task) for each of tasks, in order, running
+  # them in a pool of jobs worker processes if jobs is more than one.
+  if jobs <= 1:
+    task_fn = functools.partial(task_fn, options)
+    for task in tasks:
+      yield task_fn(task)
+    return
+
+  worker_options = { name: options.pop(name) for name in WORKER_OPTIONS if name in options }
+  task_fn = functools.partial(task_fn, options)
+
+  # Each worker has its own copy of the caches and the attachment
+  # store, so their stats counters are sent back with each result
+  # and added to the objects passed in.
+  counted = [name for name, value in worker_options.items() if value is not None]
+  task_fn = functools.partial(_counted_task, task_fn, counted)
+  def result(async_result):
+    result, counts = async_result.get()
+    for name, count in counts.items():
+      _add_counters(worker_options[name], count)
+    return result
+
+  import multiprocessing
+  if max_pending is None:
+    max_pending = 4 * jobs
+  with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(worker_options,)) as pool:
+    # Hand out one file at a time: conversion time varies a lot from
+    # file to file (RTF bodies, large attachments), so larger chunks
+    # would leave workers idle behind a slow one. (Pool.imap would
+    # do the same but reads all of tasks up front.)
+    pending = collections.deque()
+    for task in tasks:
+      pending.append(pool.apply_async(task_fn, (task,)))
+      if len(pending) >= max_pending:
+        yield result(pending.popleft())
+    while pending:
+      yield result(pending.popleft())
+
+
+def _counted_task(task_fn, counted, task):
+  # Run task_fn(task) in a worker and return its result with how much
+  # it added to the stats counters of the worker options named in
+  # counted.
+  before = { name: _counters(_worker_options[name]) for name in counted }
+  result = task_fn(task)
+  counts = { }
+  for name in counted:
+    after = _counters(_worker_options[name])
+    counts[name] = { key: after[key] - before[name][key] for key in after }
+  return result, counts
+
+
+# MAILBOX OUTPUT
+
+# Writing one small file per message is slow where each file costs a
+# round trip for its metadata (network filesystems, object-store
+# mounts). These write a stream of messages, such as the results of
+# load() or load_files(), to a single mbox file instead, or deliver
+# them to a Maildir.
+
+MBOX_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def write_mbox(messages, path_or_stream, buffer_size=MBOX_BUFFER_SIZE):
+  # Append messages to an mbox file (a path, opened with a write
+  # buffer of buffer_size bytes, or a binary file-like object) and
+  # return the number of messages written. Each message starts with a
+  # "From " line giving the sender and date taken from its From and
+  # Date headers, and lines in it that start with "From " are quoted
+  # with ">" the mboxrd way (as are lines that were already quoted,
+  # so that readers can undo it). The file isn't locked.
+  if not isinstance(path_or_stream, (str, bytes, os.PathLike)):
+    return _write_mbox(messages, path_or_stream)
+  with open(path_or_stream, "ab", buffering=buffer_size) as f:
+    return _write_mbox(messages, f)
+
+
+def _write_mbox(messages, fp):
+  count = 0
+  writer = _MboxWriter(fp)
+  for msg in messages:
+    fp.write(mbox_from_line(msg))
+    write_message(msg, writer)
+    writer.end_message()
+    count += 1
+  return count
+
+
+def mbox_from_line(msg):
+  # Return the "From " line that starts msg in an mbox file.
+  sender = None
+  addresses = getattr(msg["From"], "addresses", None)
+  if addresses:
+    sender = addresses[0].addr_spec
+  if not sender or re.search(r"\s", sender):
+    sender = "MAILER-DAEMON"
+  date = getattr(msg["Date"], "datetime", None)
+  date = date.utctimetuple() if date is not None else time.gmtime()
+  return "From {} {}\n".format(sender, time.asctime(date)).encode("ascii", "replace")
+
+
+class _MboxWriter(object):
+  # A binary file-like object that writes to fp with lines that start
+  # with "From " (after any number of ">") quoted with another ">".
+  # The last line written is held back until it is complete.
+
+  FROM_LINE = re.compile(rb"^(>*From )", re.M)
+
+  def __init__(self, fp):
+    self.fp = fp
+    self.pending = b""
+
+  def write(self, data):
+    size = len(data)
+    data = self.pending + data
+    end = data.rfind(b"\n") + 1
+    self.pending = data[end:]
+    if end:
+      self.fp.write(self.FROM_LINE.sub(rb">\1", data[:end]))
+    return size
+
+  def end_message(self):
+    # Finish the last line of a message and add the blank line that
+    # separates messages.
+    if self.pending:
+      self.fp.write(self.FROM_LINE.sub(rb">\1", self.pending) + b"\n")
+      self.pending = b""
+    self.fp.write(b"\n")
+
+
+def write_maildir(messages, directory):
+  # Deliver messages to the Maildir directory (creating it if needed)
+  # and return the number of messages delivered. Each message is
+  # written to a file in tmp and then moved to new, so that mail
+  # readers never see a partly written message.
+  import socket
+  for subdir in ("tmp", "new", "cur"):
+    os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+  hostname = socket.gethostname().replace("/", "\\057").replace(":", "\\072")
+  count = 0
+  for msg in messages:
+    now = time.time()
+    name = "{}.M{}P{}Q{}.{}".format(int(now), int(now % 1 * 1000000), os.getpid(), count,
+      hostname)
+    with _atomic_write(os.path.join(directory, "new", name),
+        temp_dir=os.path.join(directory, "tmp")) as f:
+      write_message(msg, f)
+    count += 1
+  return count
+
+
+# PIPE MODE
+
+# To save starting a process for every message, a long-lived worker
+# can convert a stream of messages sent to it over a pipe by another
+# program. Each .msg file is sent as a frame: its length as an 8-byte
+# big-endian unsigned integer, then its content. For each one, in
+# order, the worker sends back a status byte (PIPE_OK or PIPE_ERROR),
+# the length of the result as an 8-byte big-endian unsigned integer,
+# and the result: the .eml file, or the error message in UTF-8. The
+# worker stops when its input ends between frames.
+
+PIPE_REQUEST_HEADER = struct.Struct(">Q")
+PIPE_RESPONSE_HEADER = struct.Struct(">BQ")
+PIPE_OK = 0
+PIPE_ERROR = 1
+
+
+def serve_pipe(src, dst, **options):
+  # Convert the .msg files framed in the binary file-like object src
+  # with convert() and write the framed results to dst, flushing it
+  # after each, until src ends. options are passed on to convert().
+  # Return the number of messages converted (or not). Raises EOFError
+  # if src ends in the middle of a request.
+  count = 0
+  with _from_memory():
+    while True:
+      header = _read_exactly(src, PIPE_REQUEST_HEADER.size)
+      if not header:
+        return count
+      if len(header) < PIPE_REQUEST_HEADER.size:
+        raise EOFError("input ended in the middle of a message's length")
+      length, = PIPE_REQUEST_HEADER.unpack(header)
+      data = _read_exactly(src, length)
+      if len(data) < length:
+        raise EOFError("input ended in the middle of a message")
+
+      status, result = _serve_request(options, 0, data)
+      del data
+      dst.write(PIPE_RESPONSE_HEADER.pack(status, len(result)))
+      dst.write(result)
+      dst.flush()
+      count += 1
+
+
+@contextlib.contextmanager
+def _from_memory():
+  # Convert messages read from memory (rather than from files), which
+  # compoundfiles warns about, without the warnings.
+  import warnings
+  from compoundfiles import CompoundFileEmulationWarning
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore", CompoundFileEmulationWarning)
+    yield
+
+
+def _read_exactly(src, size):
+  # Read size bytes from src, or fewer if it ends first.
+  chunks = []
+  while size:
+    chunk = src.read(size)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    size -= len(chunk)
+  return b"".join(chunks)
+
+
+# CONVERSION SERVER
+
+# serve_socket() runs a server on a Unix domain socket that converts
+# .msg files for any number of clients at once, in a pool of worker
+# processes that have already imported everything a conversion needs.
+# Clients send requests framed like those of pipe mode, but with a
+# byte before the length saying what is wanted: the bits SERVER_PATH
+# (the content is the path of a .msg file, in UTF-8, instead of the
+# file itself) and SERVER_JSON (return the message's properties as
+# JSON, as extract_properties(), instead of the .eml file). Responses
+# are framed the same as in pipe mode. A client may send any number
+# of requests, one after another, on the same connection.
+
+SERVER_REQUEST_HEADER = struct.Struct(">BQ")
+SERVER_PATH = 1
+SERVER_JSON = 2
+
+
+def serve_socket(path, jobs=1, max_tasks_per_worker=None, ready=None, **options):
+  # Listen on a Unix domain socket at path (replacing a socket left
+  # there before) and serve requests until interrupted or sent
+  # SIGTERM (which makes it exit), converting
+  # in a pool of jobs worker processes. Each worker is replaced after
+  # max_tasks_per_worker requests, if given, so that memory it holds
+  # on to is given back. options are passed on to convert(), and
+  # those in WORKER_OPTIONS are kept for the life of each worker.
+  # ready, if given, is called once the socket is listening.
+  #
+  # The socket is created accessible only to its owner, since the
+  # server reads any file that a client gives it the path of.
+  import multiprocessing, signal, socketserver, stat
+  preload() # once, for the workers forked from here
+  worker_options = { name: options.pop(name) for name in WORKER_OPTIONS if name in options }
+  task_fn = functools.partial(_serve_request, options)
+
+  class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+      while True:
+        header = _read_exactly(self.rfile, SERVER_REQUEST_HEADER.size)
+        if len(header) < SERVER_REQUEST_HEADER.size:
+          return
+        kind, length = SERVER_REQUEST_HEADER.unpack(header)
+        data = _read_exactly(self.rfile, length)
+        if len(data) < length:
+          return
+        status, result = pool.apply(task_fn, (kind, data))
+        del data
+        self.wfile.write(PIPE_RESPONSE_HEADER.pack(status, len(result)))
+        self.wfile.write(result)
+        self.wfile.flush()
+
+  class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+  try:
+    if stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+  except FileNotFoundError:
+    pass
+  umask = os.umask(0o177)
+  try:
+    server = Server(path, Handler)
+  finally:
+    os.umask(umask)
+
+  # On SIGTERM, exit through the finally clause below, so that the
+  # socket file is removed. (Signal handlers can only be set in the
+  # main thread.)
+  def stop(signum, frame):
+    raise SystemExit(0)
+  previous_handler = None
+  if threading.current_thread() is threading.main_thread():
+    previous_handler = signal.signal(signal.SIGTERM, stop)
+
+  try:
+    with multiprocessing.Pool(jobs, initializer=_init_server_worker, initargs=(worker_options,),
+        maxtasksperchild=max_tasks_per_worker) as pool:
+      if ready is not None:
+        ready()
+      server.serve_forever()
+  finally:
+    if previous_handler is not None:
+      signal.signal(signal.SIGTERM, previous_handler)
+    server.server_close()
+    os.unlink(path)
+
+
+# The modules that preload imports.
+PRELOAD_MODULES = ("compoundfiles", "compoundfiles.streams", "compressed_rtf", "html2text",
+  "rtfparse.parser", "rtfparse.renderers.html_decapsulator",
+  "hashlib", "json", "shutil", "tempfile")
+
+def preload():
+  # Import the modules that conversions otherwise import when they
+  # first need them, so that a long-lived process pays for them once,
+  # up front.
+  import importlib
+  for name in PRELOAD_MODULES:
+    importlib.import_module(name)
+  _html_text_extractor()
+
+
+def _init_server_worker(worker_options):
+  import signal, warnings
+  from compoundfiles import CompoundFileEmulationWarning
+  # The pool stops its workers with SIGTERM, which they take from the
+  # server if they are forked while its handler is set.
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  _init_worker(worker_options)
+  preload()
+  # Messages sent to the server are read from memory, which
+  # compoundfiles warns about.
+  warnings.simplefilter("ignore", CompoundFileEmulationWarning)
+
+
+def _serve_request(options, kind, data):
+  # Carry out a pipe mode or server request and return its status and
+  # result.
+  if _worker_options:
+    options = dict(options, **_worker_options)
+  try:
+    src = data.decode("utf-8") if kind & SERVER_PATH else io.BytesIO(data)
+    if kind & SERVER_JSON:
+      import json
+      properties = extract_properties(src, zero_copy=options.get("zero_copy", False))
+      return PIPE_OK, json.dumps(properties).encode("utf-8")
+    output = io.BytesIO()
+    convert(src, output, **options)
+    return PIPE_OK, output.getvalue()
+  except Exception as e:
+    return PIPE_ERROR, "{}: {}".format(type(e).__name__, e).encode("utf-8")
+
+
+# ASYNCIO
+
+
+async def load_async(filename_or_stream, executor=None, **options):
+  # Like load(), but for asyncio code: the conversion, including
+  # reading the file, runs in executor (a concurrent.futures executor,
+  # or the event loop's default thread pool if None) so that it doesn't
+  # block the event loop. options are passed on to load(). With a
+  # ProcessPoolExecutor, filename_or_stream must be a filename and the
+  # message comes back pickled, so spill_threshold can't be used.
+  #
+  # If the awaiting task is cancelled before the conversion starts, it
+  # doesn't run. A conversion that has started can't be interrupted,
+  # but its result is discarded.
+  import asyncio
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(executor, functools.partial(load, filename_or_stream, **options))
+
+
+async def convert_files_async(tasks, executor=None, concurrency=4, **options):
+  # Like convert_files(), but an asynchronous generator for asyncio
+  # code. tasks may be an iterable or an asynchronous iterable of
+  # (filename, output_filename) pairs. Each file is converted with
+  # convert_file in executor (see load_async), with at most
+  # concurrency conversions submitted at a time, and (filename, error)
+  # tuples are yielded as conversions finish, so that a slow file
+  # doesn't hold up the results of others.
+  #
+  # If the generator is closed or the task iterating it is cancelled,
+  # the conversions that haven't started yet are cancelled.
+  import asyncio
+  loop = asyncio.get_running_loop()
+  task_fn = functools.partial(_convert_file_task, options)
+
+  async def iterate_tasks():
+    if hasattr(tasks, "__aiter__"):
+      async for task in tasks:
+        yield task
+    else:
+      for task in tasks:
+        yield task
+
+  pending = set()
+  try:
+    async for task in iterate_tasks():
+      pending.add(loop.run_in_executor(executor, task_fn, task))
+      if len(pending) >= concurrency:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+          yield future.result()
+    while pending:
+      done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      for future in done:
+        yield future.result()
+  finally:
+    for future in pending:
+      future.cancel()
+
+
 # COMMAND-LINE ENTRY POINT
 
 
-if __name__ == "__main__":
-  # If no command-line arguments are given, convert the .msg
-  # file on STDIN to .eml format on STDOUT.
-  if len(sys.argv) <= 1:
-    print(load(sys.stdin), file=sys.stdout)
-
-  # Otherwise, for each file mentioned on the command-line,
-  # convert it and save it to a file with ".eml" appended
-  # to the name.
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(
+    description="Convert Microsoft Outlook .msg files to .eml (MIME) format.")
+  parser.add_argument("files", nargs="*", metavar="FILE",
+    help=".msg files to convert; each is written to FILE.eml (if no files or "
+         "--input-dir are given, the .msg file on STDIN is converted to STDOUT)")
+  parser.add_argument("--input-dir", metavar="DIR",
+    help="also convert all .msg files in DIR and its subdirectories")
+  output = parser.add_mutually_exclusive_group()
+  output.add_argument("--output-dir", metavar="DIR",
+    help="write .eml files to DIR instead of next to the .msg files, in the same "
+         "directory layout as under --input-dir (or, for FILEs, as under the deepest "
+         "directory they are all in)")
+  output.add_argument("--mbox", metavar="FILE",
+    help="append the messages to the mbox file FILE instead of writing .eml files")
+  output.add_argument("--maildir", metavar="DIR",
+    help="deliver the messages to the Maildir DIR instead of writing .eml files")
+  output.add_argument("--ndjson", metavar="FILE",
+    help="instead of converting the messages, write their properties to FILE (- for "
+         "STDOUT) as JSON, one line per message")
+  output.add_argument("--pipe", action="store_true",
+    help="convert a stream of length-prefixed .msg files on STDIN, writing length-prefixed "
+         "results to STDOUT, until STDIN ends (see PIPE MODE in the source)")
+  output.add_argument("--serve", metavar="SOCKET",
+    help="run a server on the Unix domain socket SOCKET that converts .msg files for its "
+         "clients with --jobs worker processes (see CONVERSION SERVER in the source)")
+  parser.add_argument("-j", "--jobs", type=int, default=1,
+    help="number of worker processes to convert files with (0 = one per CPU)")
+  parser.add_argument("--max-tasks-per-worker", type=int, metavar="N",
+    help="with --serve, replace each worker process after it has served N requests")
+  parser.add_argument("--zero-copy", action="store_true",
+    help="memory-map input files and read large streams without copying them")
+  parser.add_argument("--rtf-cache", action="store_true",
+    help="cache HTML bodies decoded from RTF so that repeated bodies are only decoded once")
+  parser.add_argument("--rtf-cache-dir", metavar="DIR",
+    help="also keep the RTF body cache in DIR, across runs and worker processes "
+         "(implies --rtf-cache)")
+  parser.add_argument("--rtf-cache-size", type=int, default=1024, metavar="MB",
+    help="size of the cache in --rtf-cache-dir, in megabytes (default: %(default)s)")
+  parser.add_argument("--text-backfill", choices=sorted(TEXT_BACKFILLS), default="html2text",
+    help="how to make a plain-text body for messages that only have an HTML body "
+         "(fast = strip the tags; none = keep just the HTML body)")
+  parser.add_argument("--text-backfill-limit", type=int, metavar="CHARS",
+    help="use the fast method for HTML bodies longer than this")
+  parser.add_argument("--cache-dir", metavar="DIR",
+    help="keep converted messages in DIR and copy them from there when the same "
+         ".msg file is converted again")
+  parser.add_argument("--cache-size", type=int, default=1024, metavar="MB",
+    help="size of the cache in --cache-dir, in megabytes (default: %(default)s)")
+  parser.add_argument("--attachment-store", metavar="DIR",
+    help="write each distinct attachment once to DIR, named by its hash, and refer "
+         "to it from the .eml files instead of including it")
+  parser.add_argument("--attachment-store-min-size", type=int, default=0, metavar="BYTES",
+    help="include attachments smaller than this in the .eml files (default: %(default)s)")
+  parser.add_argument("--max-depth", type=int, metavar="N",
+    help="attach messages nested more than N levels deep as .msg files instead of "
+         "converting them")
+  parser.add_argument("--max-embedded-bytes", type=int, metavar="BYTES",
+    help="attach messages as .msg files instead of converting them once the attached "
+         "messages converted in a message add up to more than this")
+  parser.add_argument("--budget-bytes", type=int, metavar="BYTES",
+    help="reject (or, with --over-budget degrade, leave attachments out of) messages "
+         "whose streams add up to more than this")
+  parser.add_argument("--budget-attachments", type=int, metavar="N",
+    help="the same for messages with more than N attachments")
+  parser.add_argument("--budget-seconds", type=float, metavar="SECONDS",
+    help="stop converting a message (or leave out its remaining attachments) after this long")
+  parser.add_argument("--over-budget", choices=("reject", "degrade"), default="reject",
+    help="what to do with a message over the budget (default: %(default)s)")
+  args = parser.parse_args(argv)
+
+  budget = None
+  if args.budget_bytes is not None or args.budget_attachments is not None or \
+      args.budget_seconds is not None:
+    budget = ResourceBudget(max_bytes=args.budget_bytes, max_attachments=args.budget_attachments,
+      max_seconds=args.budget_seconds, degrade=args.over_budget == "degrade")
+
+  if (args.pipe or args.serve) and (args.files or args.input_dir):
+    parser.error("--pipe and --serve take the files from their clients")
+
+  # The options that every mode converts the messages with.
+  jobs = args.jobs or os.cpu_count() or 1
+  rtf_cache = None
+  if args.rtf_cache or args.rtf_cache_dir:
+    rtf_cache = RtfCache(directory=args.rtf_cache_dir,
+      max_disk_bytes=args.rtf_cache_size * 1024 * 1024)
+  cache = None
+  if args.cache_dir:
+    cache = ConversionCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+  attachment_store = None
+  if args.attachment_store:
+    attachment_store = AttachmentStore(args.attachment_store,
+      min_size=args.attachment_store_min_size)
+  options = dict(zero_copy=args.zero_copy, rtf_cache=rtf_cache, text_backfill=args.text_backfill,
+    text_backfill_limit=args.text_backfill_limit, cache=cache, attachment_store=attachment_store,
+    max_depth=args.max_depth, max_embedded_bytes=args.max_embedded_bytes, budget=budget)
+
+  # In pipe mode, convert each .msg file framed on STDIN to .eml
+  # format framed on STDOUT.
+  if args.pipe:
+    try:
+      serve_pipe(sys.stdin.buffer, sys.stdout.buffer, **options)
+    except EOFError as e:
+      print("--pipe: {}".format(e), file=sys.stderr)
+      return 1
+    return 0
+
+  # With --serve, run a server until interrupted.
+  if args.serve:
+    try:
+      serve_socket(args.serve, jobs=jobs, max_tasks_per_worker=args.max_tasks_per_worker,
+        ready=lambda: print("Listening on {}".format(args.serve), file=sys.stderr), **options)
+    except KeyboardInterrupt:
+      pass
+    return 0
+
+  # If no files are given, convert the .msg file on STDIN to
+  # .eml format on STDOUT (or to the mailbox, if one is given).
+  if not args.files and not args.input_dir:
+    stdin = sys.stdin.buffer
+    if not stdin.seekable():
+      # A pipe, which compoundfiles can't read from directly.
+      stdin = io.BytesIO(stdin.read())
+    with _from_memory():
+      if args.ndjson:
+        import json
+        with _open_output(args.ndjson) as f:
+          f.write(json.dumps(extract_properties(stdin, zero_copy=args.zero_copy)) + "\n")
+      elif args.mbox or args.maildir:
+        msg = load(stdin, **options)
+        if args.mbox:
+          write_mbox([msg], args.mbox)
+        else:
+          write_maildir([msg], args.maildir)
+      else:
+        convert(stdin, sys.stdout.buffer, **options)
+        sys.stdout.buffer.flush()
+    return 0
+
+  # Otherwise, for each file mentioned on the command-line
+  # or found in the input directory, convert it and save it
+  # to a file with ".eml" appended to the name, in the output
+  # directory if one is given, or add it to the mailbox (or
+  # write its properties as JSON). A failure is reported and
+  # the rest of the files are still converted.
+  failures = 0
+
+  filenames = args.files
+  if args.input_dir:
+    filenames = itertools.chain(filenames, find_msg_files(args.input_dir))
+
+  if args.ndjson:
+    # Progress isn't printed, since the output may be STDOUT.
+    import json
+    with _open_output(args.ndjson) as f:
+      for fn, properties, error in extract_files(filenames, jobs=jobs, zero_copy=args.zero_copy):
+        if error:
+          print("{}: {}".format(fn, error), file=sys.stderr)
+          failures += 1
+          continue
+        f.write(json.dumps(dict(file=fn, **properties)) + "\n")
+
+  elif args.mbox or args.maildir:
+    def messages():
+      nonlocal failures
+      for fn, msg, error in load_files(filenames, jobs=jobs, **options):
+        print(fn + "...")
+        if error:
+          print("{}: {}".format(fn, error), file=sys.stderr)
+          failures += 1
+          continue
+        yield msg
+    if args.mbox:
+      write_mbox(messages(), args.mbox)
+    else:
+      write_maildir(messages(), args.maildir)
+
   else:
-    for fn in sys.argv[1:]:
+    # In the output directory, the files given on the command line
+    # are laid out as they are under the deepest directory they are
+    # all in, so that files with the same name in different
+    # directories don't overwrite each other, and the files found in
+    # the input directory as they are under it.
+    files_root = None
+    if args.output_dir is not None and args.files:
+      try:
+        files_root = os.path.commonpath([os.path.dirname(os.path.abspath(fn))
+          for fn in args.files])
+      except ValueError: # on different drives
+        parser.error("files on different drives can't be written to one --output-dir")
+    def output_filename(fn, root):
+      if args.output_dir is None:
+        return fn + ".eml"
+      return os.path.join(args.output_dir, os.path.relpath(os.path.abspath(fn), root) + ".eml")
+    outputs = { } # output filename -> input file, for the files given
+    for fn in args.files:
+      outputs.setdefault(output_filename(fn, files_root), os.path.abspath(fn))
+    tasks = ((fn, output_filename(fn, files_root)) for fn in args.files)
+
+    if args.input_dir:
+      # A file found in the input directory may still have the same
+      # output filename as a file given on the command line.
+      def input_dir_tasks():
+        nonlocal failures
+        input_root = os.path.abspath(args.input_dir)
+        for fn in find_msg_files(args.input_dir):
+          output = output_filename(fn, input_root)
+          if outputs.get(output, os.path.abspath(fn)) != os.path.abspath(fn):
+            print("{}: not converted, since {} is also written to {}".format(fn,
+              outputs[output], output), file=sys.stderr)
+            failures += 1
+            continue
+          yield fn, output
+      tasks = itertools.chain(tasks, input_dir_tasks())
+
+    for fn, error in convert_files(tasks, jobs=jobs, **options):
       print(fn + "...")
-      msg = load(fn)
-      with open(fn + ".eml", "wb") as f:
-        f.write(msg.as_bytes())
+      if error:
+        print("{}: {}".format(fn, error), file=sys.stderr)
+        failures += 1
+
+  if attachment_store is not None:
+    stats = attachment_store.stats()
+    print("Attachment store: {attachments} attachments, {stored} new; {bytes_saved} of {bytes} "
+      "bytes were duplicates (dedup ratio {dedup_ratio:.1%})".format(**stats), file=sys.stderr)
+  if cache is not None:
+    print("Conversion cache: {hits} hits, {misses} misses (hit rate {hit_rate:.1%})".format(
+      **cache.stats()), file=sys.stderr)
+  if rtf_cache is not None:
+    print("RTF cache: {hits} hits, {misses} misses (hit rate {hit_rate:.1%})".format(
+      **rtf_cache.stats()), file=sys.stderr)
+
+  return 1 if failures else 0
+
+
+def _open_output(filename):
+  # Open a text file to write to, or STDOUT if filename is "-".
+  if filename == "-":
+    return contextlib.nullcontext(sys.stdout)
+  return open(filename, "w", encoding="utf-8")
+
+
+if __name__ == "__main__":
+  sys.exit(main())
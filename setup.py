@@ -4,7 +4,7 @@ import setuptools
 setup_path = os.path.dirname(os.path.realpath(__file__))
 
 install_requires = [
-    'compoundfiles',
+    'compoundfiles>=0.3,<0.4', # zero-copy mode uses its internals
     'compressed_rtf',
     'rtfparse',
     'html2text',
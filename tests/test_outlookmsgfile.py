@@ -0,0 +1,122 @@
+# Regression tests for outlookmsgfile.py, on synthetic .msg files made
+# with benchmarks/msggen.py.
+#
+# Usage:
+#
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import email
+import email.message
+import email.policy
+import io
+import os
+import sys
+import tempfile
+import unittest
+import warnings
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+import outlookmsgfile
+import msggen
+
+
+def setUpModule():
+  # Messages read from memory make compoundfiles warn.
+  warnings.simplefilter("ignore", ResourceWarning)
+  from compoundfiles import CompoundFileEmulationWarning
+  warnings.simplefilter("ignore", CompoundFileEmulationWarning)
+
+
+class TempDirTestCase(unittest.TestCase):
+  # A test case with a temporary directory, and a way to write a
+  # synthetic .msg file in it.
+
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.dir = temp_dir.name
+
+  def write_msg(self, name="message.msg", **kwargs):
+    path = os.path.join(self.dir, name)
+    with open(path, "wb") as f:
+      f.write(msggen.generate(**kwargs))
+    return path
+
+
+class TransportHeadersTest(unittest.TestCase):
+
+  def convert_headers(self, headers):
+    # Copy the headers into a message, write it out and parse it back.
+    msg = email.message.EmailMessage(policy=outlookmsgfile.MESSAGE_POLICY)
+    outlookmsgfile.add_headers(msg, { "TRANSPORT_MESSAGE_HEADERS": headers })
+    data = msg.as_bytes()
+    self.assertTrue(data.isascii())
+    return email.message_from_bytes(data, policy=email.policy.default)
+
+  def test_quoted_non_ascii_display_name(self):
+    msg = self.convert_headers('From: "M\u00fcller, J\u00f6rg" <j@example.de>\r\n\r\n')
+    [address] = msg["From"].addresses
+    self.assertEqual(address.display_name, "M\u00fcller, J\u00f6rg")
+    self.assertEqual(address.addr_spec, "j@example.de")
+
+  def test_non_ascii_display_name_in_comment(self):
+    msg = self.convert_headers("To: j@example.de (J\u00f6rg), \"Plain, Name\" <p@example.de>\r\n\r\n")
+    self.assertEqual([(a.display_name, a.addr_spec) for a in msg["To"].addresses],
+      [("J\u00f6rg", "j@example.de"), ("Plain, Name", "p@example.de")])
+
+  def test_non_ascii_unstructured(self):
+    msg = self.convert_headers('Subject: "Caf\u00e9" cr\u00e8me\r\n (suite)\r\n\r\n')
+    self.assertEqual(str(msg["Subject"]), '"Caf\u00e9" cr\u00e8me (suite)')
+
+
+class BudgetTest(TempDirTestCase):
+
+  def test_budget_checked_on_cache_hit(self):
+    # A message in the conversion cache is still rejected by a budget
+    # it is over.
+    path = self.write_msg(attachment_count=1, attachment_size=4096)
+    cache = outlookmsgfile.ConversionCache(os.path.join(self.dir, "cache"))
+    outlookmsgfile.load(path, cache=cache)
+    hits = cache.stats()["hits"]
+    budget = outlookmsgfile.ResourceBudget(max_bytes=10)
+    with self.assertRaises(outlookmsgfile.BudgetExceeded):
+      outlookmsgfile.load(path, cache=cache, budget=budget)
+    with self.assertRaises(outlookmsgfile.BudgetExceeded):
+      outlookmsgfile.convert(path, io.BytesIO(), cache=cache, budget=budget)
+    self.assertEqual(cache.stats()["hits"], hits)
+
+  def test_budget_within_limits_uses_cache(self):
+    path = self.write_msg()
+    cache = outlookmsgfile.ConversionCache(os.path.join(self.dir, "cache"))
+    budget = outlookmsgfile.ResourceBudget(max_bytes=10 * 1024 * 1024)
+    first = io.BytesIO()
+    outlookmsgfile.convert(path, first, cache=cache, budget=budget)
+    second = io.BytesIO()
+    outlookmsgfile.convert(path, second, cache=cache, budget=budget)
+    self.assertEqual(cache.stats()["hits"], 1)
+    self.assertEqual(first.getvalue(), second.getvalue())
+
+
+class LoadFilesTest(TempDirTestCase):
+
+  def test_spill_threshold_with_jobs_rejected(self):
+    # Messages with spilled attachments can't be sent back from worker
+    # processes, so the combination is rejected before any is loaded.
+    path = self.write_msg(attachment_count=1, attachment_size=4096)
+    with self.assertRaises(ValueError):
+      outlookmsgfile.load_files([path], jobs=2, spill_threshold=1024)
+
+  def test_spill_threshold_in_one_process(self):
+    path = self.write_msg(attachment_count=1, attachment_size=4096)
+    [(fn, msg, error)] = outlookmsgfile.load_files([path], spill_threshold=1024)
+    self.assertIsNone(error)
+    attachment = list(msg.iter_attachments())[0]
+    self.assertIsInstance(attachment, outlookmsgfile.AttachmentPart)
+    self.assertEqual(len(attachment.get_content()), 4096)
+
+
+if __name__ == "__main__":
+  unittest.main()